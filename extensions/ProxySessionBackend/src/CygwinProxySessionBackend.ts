@@ -12,7 +12,7 @@ import { Logger, Pty, SessionConfiguration, SessionBackend, CreateSessionOptions
 import { ShellStringParser } from "extraterm-shell-string-parser";
 
 import * as SourceDir from "./SourceDir.js";
-import { ProxyPtyConnector, PtyOptions } from "./ProxyPty.js";
+import { ProxyConfiguration, ProxyPtyConnector, PtyOptions } from "./ProxyPty.js";
 
 interface CygwinProxySessionConfiguration extends SessionConfiguration {
   useDefaultShell?: boolean;
@@ -181,4 +181,8 @@ class CygwinProxyPtyConnector extends ProxyPtyConnector {
     _log.debug(`this._pythonExe: ${this._pythonExe}`);
     return child_process.spawn(this._pythonExe, [path.join(SourceDir.path, "python/ptyserver2.py")], {env: serverEnv});
   }
+
+  protected _getConfiguration(): ProxyConfiguration {
+    return { framing: "binary", processTracking: true };
+  }
 }
\ No newline at end of file
@@ -4,6 +4,7 @@
  * This source code is licensed under the MIT license which is detailed in the LICENSE.txt file.
  */
 import * as child_process from "node:child_process";
+import * as zlib from "node:zlib";
 import {Event, BufferSizeChange, Pty, Logger} from "@extraterm/extraterm-extension-api";
 import { EventEmitter } from "extraterm-event-emitter";
 
@@ -22,6 +23,22 @@ export interface PtyOptions {
   suggestedCwd?: string;
 }
 
+/**
+ * Optional server features which are requested when the proxy starts.
+ */
+export interface ProxyConfiguration {
+  // Use length prefixed binary frames for messages from the server instead of JSON lines.
+  framing?: "json" | "binary";
+
+  // Compress everything from the server as one zlib stream. Fewer bytes cross
+  // the process boundary at the cost of some CPU on both sides.
+  compression?: "none" | "zlib";
+
+  // Have the server push the foreground process and working directory of
+  // each pty when they change.
+  processTracking?: boolean;
+}
+
 
 const DEBUG_FINE = false;
 
@@ -33,6 +50,7 @@ const TYPE_CREATED = "created";
 const TYPE_WRITE = "write";
 const TYPE_OUTPUT = "output";
 const TYPE_RESIZE = "resize";
+const TYPE_RESIZE_MANY = "resize-many";
 const TYPE_CLOSE = "close";
 const TYPE_CLOSED = "closed";
 const TYPE_TERMINATE = "terminate";
@@ -40,6 +58,20 @@ const TYPE_PERMIT_DATA_SIZE = "permit-data-size";
 const TYPE_OUTPUT_WRITTEN = "output-written";
 const TYPE_GET_WORKING_DIRECTORY_REQUEST = "get-working-directory";
 const TYPE_GET_WORKING_DIRECTORY = "working-directory";
+const TYPE_CONFIGURE = "configure";
+const TYPE_CONFIGURED = "configured";
+const TYPE_PROCESS_CHANGED = "process-changed";
+
+const FRAMING_JSON = "json";
+const FRAMING_BINARY = "binary";
+
+const COMPRESSION_ZLIB = "zlib";
+
+// Binary frames start with a header of frame type (uint8), pty ID (uint32 BE)
+// and payload length (uint32 BE).
+const FRAME_HEADER_SIZE = 9;
+const FRAME_TYPE_MESSAGE = 0;
+const FRAME_TYPE_OUTPUT = 1;
 
 
 interface ProxyMessage {
@@ -71,6 +103,10 @@ interface ResizeMessage extends ProxyMessage {
   columns: number;
 }
 
+interface ResizeManyMessage extends ProxyMessage {
+  sizes: { id: number; rows: number; columns: number; }[];
+}
+
 interface CloseMessage extends ProxyMessage {
 }
 
@@ -101,6 +137,21 @@ interface GetWorkingDirectoryMessage extends ProxyMessage {
   cwd: string;
 }
 
+interface ProcessChangedMessage extends ProxyMessage {
+  pid: number;
+  name: string | null;
+  cwd: string;
+}
+
+interface ConfigureMessage extends ProxyMessage, ProxyConfiguration {
+}
+
+interface ConfiguredMessage extends ProxyMessage {
+  framing: string;
+  compression?: string;
+  resizeMany?: boolean;
+}
+
 const NULL_ID = -1;
 
 
@@ -132,6 +183,9 @@ class ProxyPty implements Pty {
 
   private _workingDirectoryResponseQueue: ( (cwd: string) => void )[] = [];
 
+  // Last working directory pushed by the server when process tracking is on.
+  private _workingDirectory: string = null;
+
   constructor(writeFunc: (msg: ProxyMessage) => void) {
     this._writeFunc = writeFunc;
 
@@ -237,6 +291,10 @@ class ProxyPty implements Pty {
   }
 
   getWorkingDirectory(): Promise<string | null> {
+    if (this._workingDirectory !== null) {
+      return Promise.resolve(this._workingDirectory);
+    }
+
     const msg: GetWorkingDirectoryRequestMessage = { type: TYPE_GET_WORKING_DIRECTORY_REQUEST, id: this._id };
     return new Promise<string | null>( (resolve, reject) => {
       this._writeMessage(this._id, msg);
@@ -253,11 +311,22 @@ class ProxyPty implements Pty {
 
     resolve(cwd);
   }
+
+  workingDirectoryChanged(cwd: string): void {
+    this._workingDirectory = cwd;
+  }
 }
 
 export abstract class ProxyPtyConnector {
   private _ptys: ProxyPty[] = [];
-  private _messageBuffer = "";
+  private _messageBuffer: Buffer = Buffer.alloc(0);
+  private _framing = FRAMING_JSON;
+  private _inflate: zlib.Inflate = null;
+  private _compressionStarting = false;
+
+  // Resizes are batched into resize-many messages when the server supports them.
+  private _resizeMany = false;
+  private _pendingResizes = new Map<number, ResizeMessage>();
   private _proxy: child_process.ChildProcess = null;
 
   private _onProxyClosedEmitter = new EventEmitter<void>();
@@ -270,12 +339,18 @@ export abstract class ProxyPtyConnector {
   start(): void {
     this._proxy = this._spawnServer();
 
+    const configuration = this._getConfiguration();
+    if (configuration != null) {
+      const msg: ConfigureMessage = { type: TYPE_CONFIGURE, id: NULL_ID, ...configuration };
+      this._sendMessage(msg);
+    }
+
     this._proxy.stdout.on('data', (data: Buffer) => {
-      if (DEBUG_FINE) {
-        this._log.debug("server -> main: ", data.toString("utf8"));
+      if (this._inflate !== null) {
+        this._inflate.write(data);
+      } else {
+        this._processServerData(data);
       }
-      this._messageBuffer = this._messageBuffer + data.toString('utf8');
-      this._processMessageBuffer();
     });
 
     this._proxy.stderr.on('data', (data: Buffer) => {
@@ -299,8 +374,47 @@ export abstract class ProxyPtyConnector {
     });
   }
 
+  private _processServerData(data: Buffer): void {
+    if (DEBUG_FINE) {
+      this._log.debug("server -> main: ", data.toString("utf8"));
+    }
+    this._messageBuffer = this._messageBuffer.length === 0 ? data : Buffer.concat([this._messageBuffer, data]);
+    this._processMessageBuffer();
+  }
+
+  /**
+   * Pass everything from the server through zlib from now on.
+   *
+   * @param compressed Data which has already arrived after the configured message.
+   */
+  private _startDecompression(compressed: Buffer): void {
+    // The server sync flushes the stream after each batch of messages.
+    this._inflate = zlib.createInflate({ flush: zlib.constants.Z_SYNC_FLUSH });
+    this._inflate.on("data", (data: Buffer) => {
+      this._processServerData(data);
+    });
+    this._inflate.on("error", (err) => {
+      this._log.warn("Unable to decompress data from the proxy. ", err);
+      this._gracefullyAbortAll();
+    });
+    if (compressed.length !== 0) {
+      this._inflate.write(compressed);
+    }
+  }
+
   protected abstract _spawnServer(): child_process.ChildProcess;
 
+  /**
+   * Features to request from the server when it starts.
+   *
+   * @return The configuration to request, or null to not send a configure
+   *          message at all. Only servers which understand the configure
+   *          message should be sent one.
+   */
+  protected _getConfiguration(): ProxyConfiguration {
+    return null;
+  }
+
   spawn(options: PtyOptions): Pty {
     let rows = 24;
     let columns = 80;
@@ -337,30 +451,92 @@ export abstract class ProxyPtyConnector {
   }
 
   private _processMessageBuffer(): void {
-    while (true) {
-      const end = this._messageBuffer.indexOf('\n');
-      if (end !== -1) {
-        const msgString = this._messageBuffer.slice(0, end);
-        this._messageBuffer = this._messageBuffer.slice(end+1);
-
-        try {
-          const msg = <ProxyMessage> JSON.parse(msgString);
-          this._processMessage(msg);
-        } catch(ex) {
-          // This can blow up if the proxy process dies unexpectedly.
-          this._log.warn(ex);
-          this._gracefullyAbortAll();
+    let offset = 0;
+    try {
+      while (true) {
+        // Note: The framing can change part way through the buffer.
+        const consumed = this._framing === FRAMING_BINARY ? this._processFrame(offset) : this._processLine(offset);
+        if (consumed === 0) {
+          break;
+        }
+        offset += consumed;
+
+        if (this._compressionStarting) {
+          // Everything after the configured message is compressed.
+          this._compressionStarting = false;
+          const compressed = this._messageBuffer.subarray(offset);
+          this._messageBuffer = Buffer.alloc(0);
+          this._startDecompression(compressed);
           return;
         }
-      } else {
-        return;
       }
+    } catch(ex) {
+      // This can blow up if the proxy process dies unexpectedly.
+      this._log.warn(ex);
+      this._gracefullyAbortAll();
+      return;
+    }
+    this._messageBuffer = this._messageBuffer.subarray(offset);
+  }
+
+  /**
+   * Process one JSON line message from the message buffer.
+   *
+   * @return The number of bytes consumed, or 0 if there is no complete message.
+   */
+  private _processLine(offset: number): number {
+    const end = this._messageBuffer.indexOf(0x0a, offset);  // '\n'
+    if (end === -1) {
+      return 0;
+    }
+    const msg = <ProxyMessage> JSON.parse(this._messageBuffer.toString("utf8", offset, end));
+    this._processMessage(msg);
+    return end + 1 - offset;
+  }
+
+  /**
+   * Process one binary frame from the message buffer.
+   *
+   * @return The number of bytes consumed, or 0 if there is no complete frame.
+   */
+  private _processFrame(offset: number): number {
+    const buffer = this._messageBuffer;
+    if (buffer.length - offset < FRAME_HEADER_SIZE) {
+      return 0;
+    }
+    const payloadStart = offset + FRAME_HEADER_SIZE;
+    const end = payloadStart + buffer.readUInt32BE(offset + 5);
+    if (end > buffer.length) {
+      return 0;
+    }
+
+    const frameType = buffer.readUInt8(offset);
+    if (frameType === FRAME_TYPE_OUTPUT) {
+      const pty = this._findPtyById(buffer.readUInt32BE(offset + 1));
+      if (pty !== null) {
+        pty.data(buffer.toString("utf8", payloadStart, end));
+      }
+    } else if (frameType === FRAME_TYPE_MESSAGE) {
+      this._processMessage(<ProxyMessage> JSON.parse(buffer.toString("utf8", payloadStart, end)));
+    } else {
+      throw new Error(`Unknown frame type ${frameType} received from the proxy.`);
     }
+    return end - offset;
   }
 
   private _processMessage(msg: ProxyMessage): void {
     const msgType = msg.type;
 
+    if (msgType === TYPE_CONFIGURED) {
+      const configuredMsg = <ConfiguredMessage> msg;
+      this._framing = configuredMsg.framing;
+      if (configuredMsg.compression === COMPRESSION_ZLIB && this._inflate === null) {
+        this._compressionStarting = true;
+      }
+      this._resizeMany = configuredMsg.resizeMany === true;
+      return;
+    }
+
     if (msgType === TYPE_CREATED) {
       const createdPtyMsg = <CreatedPtyMessage> msg;
       for (let i=0; i<this._ptys.length; i++) {
@@ -405,6 +581,15 @@ export abstract class ProxyPtyConnector {
       if (pty !== null) {
         pty.workingDirectoryResponse(getWorkingDirectoryMsg.cwd);
       }
+      return;
+    }
+
+    if (msgType === TYPE_PROCESS_CHANGED) {
+      const processChangedMsg = <ProcessChangedMessage> msg;
+      const pty = this._findPtyById(processChangedMsg.id);
+      if (pty !== null) {
+        pty.workingDirectoryChanged(processChangedMsg.cwd);
+      }
     }
   }
 
@@ -418,6 +603,34 @@ export abstract class ProxyPtyConnector {
   }
 
   private _sendMessage(msg: ProxyMessage): void {
+    if (this._resizeMany && msg.type === TYPE_RESIZE) {
+      // Resizing a window or splitter resizes many ptys at once. Send them together.
+      if (this._pendingResizes.size === 0) {
+        setImmediate(() => this._flushResizes());
+      }
+      this._pendingResizes.set(msg.id, <ResizeMessage> msg);
+      return;
+    }
+
+    // Keep the resizes in order with other messages.
+    this._flushResizes();
+    this._writeToServer(msg);
+  }
+
+  private _flushResizes(): void {
+    if (this._pendingResizes.size === 0) {
+      return;
+    }
+    const sizes: { id: number; rows: number; columns: number; }[] = [];
+    for (const resizeMsg of this._pendingResizes.values()) {
+      sizes.push({ id: resizeMsg.id, rows: resizeMsg.rows, columns: resizeMsg.columns });
+    }
+    this._pendingResizes.clear();
+    const msg: ResizeManyMessage = { type: TYPE_RESIZE_MANY, id: NULL_ID, sizes };
+    this._writeToServer(msg);
+  }
+
+  private _writeToServer(msg: ProxyMessage): void {
     const msgText = JSON.stringify(msg);
     if (DEBUG_FINE) {
       this._log.debug("main -> server: ", msgText);
@@ -1,3 +1,16 @@
+import sys
+
 from .ptyprocess import PtyProcess, PtyProcessUnicode, PtyProcessError
 
+if sys.version_info >= (3, 7):
+    # Loaded on first use, importing asyncio would slow down every start up.
+    def __getattr__(name):
+        if name == 'AsyncPtyProcess':
+            from ._async import AsyncPtyProcess
+            return AsyncPtyProcess
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+elif sys.version_info >= (3, 5):
+    # Module __getattr__ needs Python 3.7 (PEP 562), so import it up front.
+    from ._async import AsyncPtyProcess
+
 __version__ = '0.5'
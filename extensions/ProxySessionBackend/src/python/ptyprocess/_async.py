@@ -0,0 +1,262 @@
+import asyncio
+import errno
+import os
+import signal
+import time
+
+from .ptyprocess import PtyProcess, PtyProcessError
+
+# How often wait() checks on the child when pidfds are not available.
+_EXIT_POLL_INTERVAL = 0.05
+
+try:
+    _get_running_loop = asyncio.get_running_loop
+except AttributeError:
+    # Python < 3.7. Inside a coroutine this returns the running loop too.
+    _get_running_loop = asyncio.get_event_loop
+
+
+class AsyncPtyProcess(PtyProcess):
+    """A process running in a pseudoterminal, for use with asyncio.
+
+    The master fd is non-blocking and :meth:`read`, :meth:`write`,
+    :meth:`drain`, :meth:`wait` and :meth:`terminate` are coroutines which
+    wait on the event loop instead of blocking it. One loop can serve many
+    of these.
+
+    The main constructor is the :meth:`spawn` classmethod. The coroutines
+    use whichever event loop is running when they are called.
+    """
+
+    def __init__(self, pid, fd):
+        super(AsyncPtyProcess, self).__init__(pid, fd)
+        os.set_blocking(fd, False)
+        self._writer_loop = None    # The loop watching for writability, if any.
+        self._read_buffer = b''
+        self._reached_eof = False
+        self._write_buffer = bytearray()
+        self._write_error = None
+        self._drain_waiters = []
+
+    async def _wait_readable(self, fd):
+        loop = _get_running_loop()
+        future = loop.create_future()
+        loop.add_reader(fd, future.set_result, None)
+        try:
+            await future
+        finally:
+            loop.remove_reader(fd)
+
+    def _read_nowait(self, size):
+        """Read from the pty. Returns None if nothing is available yet."""
+        try:
+            s = self.fileobj.read(size)
+        except (OSError, IOError) as err:
+            if err.args[0] == errno.EIO:
+                # Linux-style EOF
+                self._reached_eof = True
+                raise EOFError('End Of File (EOF). Exception style platform.')
+            raise
+        if s == b'':
+            # BSD-style EOF
+            self._reached_eof = True
+            raise EOFError('End Of File (EOF). Empty string style platform.')
+        return s
+
+    async def read(self, size=1024):
+        """Read and return at most ``size`` bytes from the pty.
+
+        Waits until there is something to read. Raises :exc:`EOFError` if the
+        terminal was closed.
+        """
+        if self._read_buffer:
+            s = self._read_buffer[:size]
+            self._read_buffer = self._read_buffer[size:]
+            return s
+        while True:
+            s = self._read_nowait(size)
+            if s is not None:
+                return s
+            await self._wait_readable(self.fd)
+
+    async def readline(self):
+        """Read one line from the pseudoterminal.
+
+        Waits until a whole line is available. Raises :exc:`EOFError` if the
+        terminal was closed before anything was read. Data read after the
+        newline is kept for the next :meth:`read` or :meth:`readline`.
+        """
+        while True:
+            end = self._read_buffer.find(b'\n')
+            if end != -1:
+                s = self._read_buffer[:end+1]
+                self._read_buffer = self._read_buffer[end+1:]
+                return s
+            try:
+                s = self._read_nowait(4096)
+            except EOFError:
+                if self._read_buffer:
+                    s = self._read_buffer
+                    self._read_buffer = b''
+                    return s
+                raise
+            if s is None:
+                await self._wait_readable(self.fd)
+            else:
+                self._read_buffer += s
+
+    def write_nowait(self, s):
+        """Queue bytes to be written to the pseudoterminal.
+
+        As much as possible is written immediately and the rest is written as
+        the pty accepts it. Use :meth:`drain` to wait until it is all written.
+        """
+        s = self._coerce_send_string(s)
+        if self._write_error is not None:
+            raise self._write_error
+        was_empty = len(self._write_buffer) == 0
+        self._write_buffer += s
+        if was_empty:
+            self._on_writable()
+            if len(self._write_buffer) != 0:
+                self._writer_loop = _get_running_loop()
+                self._writer_loop.add_writer(self.fd, self._on_writable)
+
+    def _on_writable(self):
+        try:
+            while len(self._write_buffer) != 0:
+                written = self.fileobj.write(self._write_buffer)
+                if written is None:
+                    return  # The pty is full, wait for it to be writable.
+                del self._write_buffer[:written]
+        except (OSError, IOError) as err:
+            self._write_error = err
+            del self._write_buffer[:]
+
+        self._remove_writer()
+        waiters = self._drain_waiters
+        self._drain_waiters = []
+        for future in waiters:
+            if not future.done():
+                if self._write_error is not None:
+                    future.set_exception(self._write_error)
+                else:
+                    future.set_result(None)
+
+    async def drain(self):
+        """Wait until all queued data has been written to the pseudoterminal."""
+        if self._write_error is not None:
+            raise self._write_error
+        if len(self._write_buffer) == 0:
+            return
+        future = _get_running_loop().create_future()
+        self._drain_waiters.append(future)
+        await future
+
+    async def write(self, s):
+        """Write bytes to the pseudoterminal and wait until they are written.
+
+        Returns the number of bytes written.
+        """
+        s = self._coerce_send_string(s)
+        self.write_nowait(s)
+        await self.drain()
+        return len(s)
+
+    def eof(self):
+        '''This returns True if the EOF exception was ever raised.
+        '''
+        return self._reached_eof
+
+    async def wait(self):
+        '''Wait until the child exits and return its exit status.
+
+        This does not read any data from the child, if the child is blocked
+        writing output then it will not exit until something reads it.
+        The wait uses a pidfd where the platform has them and otherwise
+        polls the child.
+        '''
+        if not self.isalive():
+            return self.exitstatus
+
+        pidfd = None
+        if hasattr(os, 'pidfd_open'):
+            try:
+                pidfd = os.pidfd_open(self.pid)
+            except OSError:
+                pass
+        try:
+            while self.isalive():
+                if pidfd is not None:
+                    await self._wait_readable(pidfd)
+                else:
+                    await asyncio.sleep(_EXIT_POLL_INTERVAL)
+        finally:
+            if pidfd is not None:
+                os.close(pidfd)
+        return self.exitstatus
+
+    async def terminate(self, force=False):
+        '''This forces a child process to terminate. It starts nicely with
+        SIGHUP and SIGINT. If "force" is True then moves onto SIGKILL. This
+        returns True if the child was terminated. This returns False if the
+        child could not be terminated.
+
+        Unlike :meth:`PtyProcess.terminate` the delays between signals don't
+        block the event loop.
+        '''
+        sigs = [signal.SIGHUP, signal.SIGCONT, signal.SIGINT]
+        if force:
+            sigs.append(signal.SIGKILL)
+        for sig in sigs:
+            if not self.isalive():
+                return True
+            try:
+                self.kill(sig)
+            except OSError:
+                pass
+            await asyncio.sleep(self.delayafterterminate)
+        return not self.isalive()
+
+    async def aclose(self, force=True):
+        '''Close the pty and make sure the child is terminated.
+
+        This is the non-blocking version of :meth:`close`.
+        '''
+        if self.closed:
+            return
+        self._detach()
+        self.fileobj.close()
+        if not await self.terminate(force):
+            raise PtyProcessError('Could not terminate the child.')
+        self.fd = -1
+        self.closed = True
+
+    def close(self, force=True):
+        '''Close the pty. This blocks while terminating the child, inside a
+        coroutine use :meth:`aclose` instead. '''
+        if not self.closed:
+            self._detach()
+            self.fileobj.close()
+            if self.isalive():
+                # Give kernel time to update process status.
+                time.sleep(self.delayafterclose)
+                # terminate() is a coroutine here, use the blocking one.
+                if self.isalive() and not PtyProcess.terminate(self, force):
+                    raise PtyProcessError('Could not terminate the child.')
+            self.fd = -1
+            self.closed = True
+
+    def _remove_writer(self):
+        if self._writer_loop is not None:
+            if not self._writer_loop.is_closed():
+                self._writer_loop.remove_writer(self.fd)
+            self._writer_loop = None
+
+    def _detach(self):
+        self._remove_writer()
+        for future in self._drain_waiters:
+            if not future.done():
+                future.cancel()
+        self._drain_waiters = []
+
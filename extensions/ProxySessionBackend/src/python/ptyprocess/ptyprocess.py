@@ -19,7 +19,7 @@ except ImportError:
 # Constants
 from pty import (STDIN_FILENO, CHILD)
 
-from .util import which
+from .util import which_cached
 
 _platform = sys.platform.lower()
 
@@ -34,6 +34,12 @@ if _is_solaris:
 else:
     use_native_pty_fork = True
 
+# posix_spawn() starts the child without copying the parent and without
+# waiting for it to exec. It needs Python 3.8 for the setsid option and is
+# only used when there is nothing to run in the child before exec.
+use_posix_spawn = (hasattr(os, 'posix_spawn') and sys.version_info >= (3, 8)
+                   and not _is_solaris)
+
 PY3 = sys.version_info[0] >= 3
 
 if PY3:
@@ -111,6 +117,78 @@ def _setecho(fd, state):
             raise IOError(err.args[0], '%s: %s.' % (err.args[1], errmsg))
         raise
 
+def _open_fds():
+    """List the file descriptors above stderr which are open, or None if they can't be listed."""
+    for fd_dir in ('/proc/self/fd', '/dev/fd'):
+        try:
+            return [fd for fd in (int(name) for name in os.listdir(fd_dir)) if fd > 2]
+        except (OSError, ValueError):
+            pass
+    return None
+
+def _close_fds(keep_fd):
+    """Close all file descriptors above stderr except keep_fd.
+
+    Only the fds which are actually open are closed if they can be listed.
+    RLIMIT_NOFILE can be over a million, and closing every possible fd one
+    at a time then takes a long time.
+    """
+    fds = _open_fds()
+    if fds is not None:
+        for fd in fds:
+            if fd != keep_fd:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass    # The fd listdir() used is already closed.
+        return
+
+    max_fd = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    os.closerange(3, keep_fd)
+    os.closerange(keep_fd+1, max_fd)
+
+def _posix_spawn_pty(command, argv, env, echo, dimensions):
+    """Start a command in a new pty with posix_spawn(). Returns (pid, fd).
+
+    The child becomes a session leader and then opens the slave side, which
+    makes the pty its controlling terminal. Exec failures are raised here as
+    OSError. Inheritable fds of the parent are closed in the child, like the
+    fork() path does. Everything else, including the pty fds, is closed by exec.
+    """
+    parent_fd, child_fd = os.openpty()
+    try:
+        # Ignore the same errors as the fork() path does.
+        try:
+            _setwinsize(parent_fd, *dimensions)
+        except IOError as err:
+            if err.args[0] not in (errno.EINVAL, errno.ENOTTY):
+                raise
+        if not echo:
+            try:
+                _setecho(child_fd, False)
+            except (IOError, termios.error) as err:
+                if err.args[0] not in (errno.EINVAL, errno.ENOTTY):
+                    raise
+        file_actions = [
+            (os.POSIX_SPAWN_OPEN, STDIN_FILENO, os.ttyname(child_fd), os.O_RDWR, 0),
+            (os.POSIX_SPAWN_DUP2, STDIN_FILENO, 1),
+            (os.POSIX_SPAWN_DUP2, STDIN_FILENO, 2),
+        ]
+        for fd in _open_fds() or []:
+            try:
+                if os.get_inheritable(fd):
+                    file_actions.append((os.POSIX_SPAWN_CLOSE, fd))
+            except OSError:
+                pass    # The fd listdir() used is already closed.
+        pid = os.posix_spawn(command, argv, os.environ if env is None else env,
+                             file_actions=file_actions, setsid=True)
+    except BaseException:
+        os.close(parent_fd)
+        raise
+    finally:
+        os.close(child_fd)
+    return pid, parent_fd
+
 def _setwinsize(fd, rows, cols):
     # Some very old platforms have a bug that causes the value for
     # termios.TIOCSWINSZ to be truncated. There was a hack here to work
@@ -172,7 +250,7 @@ class PtyProcess(object):
     @classmethod
     def spawn(
             cls, argv, cwd=None, env=None, echo=True, preexec_fn=None,
-            dimensions=(24, 80)):
+            dimensions=(24, 80), resolve_absolute=True):
         '''Start the given command in a child process in a pseudo terminal.
 
         This does all the fork/exec type of stuff for a pty, and returns an
@@ -184,6 +262,10 @@ class PtyProcess(object):
 
         Dimensions of the psuedoterminal used for the subprocess can be
         specified as a tuple (rows, cols), or the default (24, 80) will be used.
+
+        If resolve_absolute is False and argv[0] is an absolute path, it isn't
+        checked before it is run. A command which can't be run then raises the
+        OSError from the exec, e.g. FileNotFoundError or PermissionError.
         '''
         # Note that it is difficult for this method to fail.
         # You cannot detect if the child process cannot start.
@@ -200,12 +282,27 @@ class PtyProcess(object):
         argv = argv[:]
         command = argv[0]
 
-        command_with_path = which(command)
-        if command_with_path is None:
-            raise FileNotFoundError('The command was not found or was not ' +
-                                    'executable: %s.' % command)
-        command = command_with_path
-        argv[0] = command
+        if resolve_absolute or not os.path.isabs(command):
+            command_with_path = which_cached(command)
+            if command_with_path is None:
+                raise FileNotFoundError('The command was not found or was not ' +
+                                        'executable: %s.' % command)
+            command = command_with_path
+            argv[0] = command
+
+        global use_posix_spawn
+        if use_posix_spawn and cwd is None and preexec_fn is None:
+            try:
+                pid, fd = _posix_spawn_pty(command, argv, env, echo, dimensions)
+            except NotImplementedError:
+                # Built without support for the setsid option.
+                use_posix_spawn = False
+            else:
+                inst = cls(pid, fd)
+                inst.argv = argv
+                if env is not None:
+                    inst.env = env
+                return inst
 
         # [issue #119] To prevent the case where exec fails and the user is
         # stuck interacting with a python child process instead of whatever
@@ -249,9 +346,7 @@ class PtyProcess(object):
 
             # Do not allow child to inherit open file descriptors from parent,
             # with the exception of the exec_err_pipe_write of the pipe
-            max_fd = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
-            os.closerange(3, exec_err_pipe_write)
-            os.closerange(exec_err_pipe_write+1, max_fd)
+            _close_fds(exec_err_pipe_write)
 
             if cwd is not None:
                 os.chdir(cwd)
@@ -1,7 +1,10 @@
+import os
+import time
+
 try:
     from shutil import which  # Python >= 3.3
 except ImportError:
-    import os, sys
+    import sys
     
     # This is copied from Python 3.4.1
     def which(cmd, mode=os.F_OK | os.X_OK, path=None):
@@ -64,4 +67,85 @@ except ImportError:
                     name = os.path.join(dir, thefile)
                     if _access_check(name, mode):
                         return name
-        return None
\ No newline at end of file
+        return None
+
+
+# (cmd, PATH) -> (result, [(directory, mtime), ...], time checked)
+_which_cache = {}
+_WHICH_CACHE_MAX_SIZE = 256
+# Seconds during which a cached result is used without checking the directories.
+WHICH_CACHE_TTL = 5.0
+# Seconds during which the directories before the one holding a found command
+# aren't checked again. Only the directory of the result is checked meanwhile.
+WHICH_CACHE_MISS_TTL = 300.0
+
+def _dir_mtime(dir):
+    try:
+        return os.stat(dir or os.curdir).st_mtime_ns
+    except OSError:
+        return None
+
+def _is_executable(fn):
+    return os.access(fn, os.F_OK | os.X_OK) and not os.path.isdir(fn)
+
+def which_cached(cmd, path=None):
+    """Like :func:`which`, but the result of searching PATH is cached.
+
+    Searching PATH checks every directory on it, which is slow when PATH
+    includes Windows directories. A cached result is used as is for
+    ``WHICH_CACHE_TTL`` seconds. After that it is reused as long as the
+    directories which were searched to find it keep their modification
+    times and the file found is still executable. When a command was found,
+    only its own directory is checked until ``WHICH_CACHE_MISS_TTL`` runs
+    out, so a command newly put in an earlier directory can take that long
+    to be picked up. Commands with a directory part are never searched for
+    on PATH and aren't cached.
+    """
+    if os.path.dirname(cmd):
+        return which(cmd, path=path)
+
+    if path is None:
+        path = os.environ.get("PATH", os.defpath)
+    if not path:
+        return None
+
+    key = (cmd, path)
+    now = time.monotonic()
+    entry = _which_cache.get(key)
+    if entry is not None:
+        result, dir_mtimes, checked_time, misses_checked_time = entry
+        if now - checked_time < WHICH_CACHE_TTL:
+            return result
+        if result is not None and now - misses_checked_time < WHICH_CACHE_MISS_TTL:
+            # The result's directory is the last one searched.
+            result_dir, mtime = dir_mtimes[-1]
+            if _dir_mtime(result_dir) == mtime and _is_executable(result):
+                _which_cache[key] = (result, dir_mtimes, now, misses_checked_time)
+                return result
+        elif (all(_dir_mtime(dir) == mtime for dir, mtime in dir_mtimes) and
+                (result is None or _is_executable(result))):
+            _which_cache[key] = (result, dir_mtimes, now, now)
+            return result
+
+    # Each directory's mtime is read before looking in it, so that a change
+    # made during the search invalidates the entry.
+    result = None
+    dir_mtimes = []
+    seen = set()
+    for dir in path.split(os.pathsep):
+        if dir in seen:
+            continue
+        seen.add(dir)
+        mtime = _dir_mtime(dir)
+        dir_mtimes.append((dir, mtime))
+        if mtime is None:
+            continue    # Missing directory
+        name = os.path.join(dir, cmd)
+        if _is_executable(name):
+            result = name
+            break
+
+    if len(_which_cache) >= _WHICH_CACHE_MAX_SIZE:
+        _which_cache.clear()
+    _which_cache[key] = (result, dir_mtimes, now, now)
+    return result
@@ -6,16 +6,25 @@
 
 import ptyprocess
 import select
+import selectors
 import sys
 import struct
 import fcntl
+import heapq
+import itertools
 import os
 import codecs
+import collections
+import errno
+import argparse
 import array
-import threading
 import json
+import mmap
+import signal
 import subprocess
+import tempfile
 import time
+import zlib
 
 LOG_FINE = False
 LOG_FINER = False
@@ -36,189 +45,1196 @@ def sendToMaster(data):
     sys.stdout.flush()
 
 ###########################################################################
-activity_event = threading.Event()
+PTY_READ_SIZE = 16 * 1024
+PTY_BUFFER_SIZE = 64 * 1024     # Capacity of each pty's output ring buffer.
+
+# Big chunks of output which arrive in quick succession are merged into fewer,
+# larger output messages. Output is never held back for longer than the
+# latency budget, and small chunks like keystroke echo are sent straight away.
+OUTPUT_COALESCE_SIZE = 64 * 1024    # Maximum bytes of pty output per output message.
+OUTPUT_LATENCY_BUDGET = 0.003       # Maximum seconds that output is held back.
+OUTPUT_STREAMING_CHUNK_SIZE = 1024  # Minimum read size which suggests that more output is coming.
+
+# Sessions created with a spoolSize keep reading after the permitted data size
+# has been used up for a while, so that their command isn't blocked on a pty
+# which nobody reads. The output goes into a memory-mapped temporary file.
+SPOOL_START_DELAY = 0.5     # Seconds without permission to send output before spooling starts.
+
+###########################################################################
+def utf16_length(text):
+    """Length of text in UTF-16 code units. This is what JavaScript's String.length counts."""
+    # Characters outside the BMP take a surrogate pair. Encoding is a single
+    # pass in C and much faster than searching for those characters.
+    return len(text.encode("utf_16_le")) // 2
+
+UTF8_FOUR_BYTE_LEADS = (b"\xf0", b"\xf1", b"\xf2", b"\xf3", b"\xf4")
+
+def utf16_length_of_utf8(text, encoded):
+    """utf16_length() of text, worked out from its UTF-8 encoding without encoding it again."""
+    if len(encoded) == len(text):
+        return len(text)
+    # Only characters outside the BMP take 4 bytes in UTF-8, and they take a surrogate pair in UTF-16.
+    return len(text) + sum(encoded.count(lead) for lead in UTF8_FOUR_BYTE_LEADS)
+
+###########################################################################
+# All pty and control channel I/O is multiplexed on this one selector. Each
+# registered fd carries a two element list of [read callback, write callback].
+selector = selectors.DefaultSelector()
 nbfr_counter = 0
 
+def set_fd_callback(fd, event, callback):
+    """Set (or clear with None) the callback for read or write readiness on fd."""
+    try:
+        key = selector.get_key(fd)
+        handlers = key.data
+    except KeyError:
+        key = None
+        handlers = [None, None]
+
+    handlers[0 if event == selectors.EVENT_READ else 1] = callback
+    mask = (selectors.EVENT_READ if handlers[0] is not None else 0) | \
+        (selectors.EVENT_WRITE if handlers[1] is not None else 0)
+
+    if mask == 0:
+        if key is not None:
+            selector.unregister(fd)
+    elif key is None:
+        selector.register(fd, mask, handlers)
+    elif key.events != mask:
+        selector.modify(fd, mask, handlers)
+
+
+class RingBuffer:
+    """Fixed capacity FIFO of bytes kept in one preallocated bytearray.
+
+    Data is read from fds straight into the free space, and consuming data
+    just moves the start offset.
+    """
+    def __init__(self, capacity, data=None):
+        self.capacity = capacity
+        self._data = bytearray(capacity) if data is None else data
+        self._view = memoryview(self._data)
+        self._start = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def free(self):
+        return self.capacity - self._size
+
+    def _freeSegments(self, max_size):
+        end = (self._start + self._size) % self.capacity
+        size = min(max_size, self.capacity - self._size)
+        first_size = min(size, self.capacity - end)
+        segments = [self._view[end:end+first_size]]
+        if first_size < size:
+            segments.append(self._view[0:size-first_size])
+        return segments
+
+    def readFromFd(self, fd, max_size):
+        """Read up to max_size bytes from fd into the buffer.
+
+        Returns the number of bytes read, or None if the read would block.
+        Raises EOFError at the end of the file.
+        """
+        try:
+            count = os.readv(fd, self._freeSegments(max_size))
+        except BlockingIOError:
+            return None
+        except OSError as e:
+            if e.errno == errno.EIO:
+                raise EOFError()    # Linux style EOF on a pty master.
+            raise
+        if count == 0:
+            raise EOFError()
+        self._size += count
+        return count
+
+    def write(self, data):
+        """Append as much of data as fits. Returns the number of bytes appended."""
+        offset = 0
+        for segment in self._freeSegments(len(data)):
+            segment[:] = data[offset:offset+len(segment)]
+            offset += len(segment)
+        self._size += offset
+        return offset
+
+    def consume(self, max_size):
+        """Remove up to max_size bytes from the front of the buffer.
+
+        Returns them as one or two memoryviews of the buffer, without copying.
+        They are only valid until more data is written to the buffer.
+        """
+        size = min(max_size, self._size)
+        first_size = min(size, self.capacity - self._start)
+        segments = [self._view[self._start:self._start+first_size]]
+        if first_size < size:
+            segments.append(self._view[0:size-first_size])
+        self._start = (self._start + size) % self.capacity
+        self._size -= size
+        if self._size == 0:
+            self._start = 0     # Keep future reads in one piece.
+        return segments
+
+
+class Spool(RingBuffer):
+    """Ring buffer in a memory-mapped temporary file.
+
+    It holds output which the Extraterm side hasn't given permission for yet.
+    The OS can page it out to disk. When it is full the oldest data is dropped.
+    """
+    def __init__(self, capacity):
+        self._file = tempfile.TemporaryFile(prefix="extraterm-spool-")
+        self._file.truncate(capacity)
+        self._map = mmap.mmap(self._file.fileno(), capacity)
+        super().__init__(capacity, self._map)
+
+    def makeRoom(self, size):
+        """Drop the oldest data until size bytes are free. Returns the number of bytes dropped."""
+        evicted = min(self._size, size - self.free())
+        if evicted <= 0:
+            return 0
+        self._start = (self._start + evicted) % self.capacity
+        self._size -= evicted
+        return evicted
+
+    def close(self):
+        self._view.release()
+        self._map.close()
+        self._file.close()
+
+
 class NonblockingFileReader:
-    def __init__(self, file_object=None, read=None):
+    def __init__(self, fd=None, read=None, activity_callback=None, spool_size=0):
         global nbfr_counter
-        
-        self.file_object = file_object
+
+        # fd is the file descriptor to watch for readability. For readers which
+        # never block, fd is None and `read` is used to fetch data.
+        self.fd = fd
         self._custom_read = read
+        # Called when data has been added to the buffer.
+        self._activity_callback = activity_callback
+        self._closed = False
 
-        # These are used to throttle our reading and sending of data.
-        self._read_valve = threading.Event()
-        self._read_valve.clear()
+        # This is used to throttle our reading and sending of data. It is
+        # counted in UTF-16 code units, the same as the Extraterm side does.
         self._permit_data_size = 0
+        # The tail of the last chunk which ended part way through a UTF-8 sequence.
+        self._undecoded = b""
 
         self.id = nbfr_counter
         nbfr_counter += 1
-        
+
         self._isEOF = False
-        
-        self.buffer = []
-        self.buffer_lock = threading.RLock()
-        
-        self.thread = threading.Thread(name="Nonblocking File Reader "+str(self.id),
-            target=self._thread_start)
-        self.thread.daemon = True
-        self.thread.start()
-
-    def read(self):
-        with self.buffer_lock:
-            if len(self.buffer) != 0:
-                chunk = self.buffer[0]
-                del self.buffer[0]
-                return chunk
-            else:
-                return None
+
+        # Allocated when data is first permitted. Ptys which are never read don't need one.
+        self.buffer = None
+        self._buffer_start_time = 0     # When the oldest data in the buffer was read.
+        self._last_read_time = 0
+        self._streaming = False  # True if big chunks are arriving in quick succession.
+
+        # Output read while the permitted data size is used up, see _isSpooling().
+        # The spool is created when it is first needed. A spool size of 0 turns spooling off.
+        self._spool_size = spool_size
+        self._spool = None
+        self.spool_evicted_bytes = 0
+
+        # Counters for the stats command.
+        self.bytes_read = 0
+        self.read_count = 0
+        self.output_count = 0   # Pieces of output handed out by readOutput().
+        self._credit_blocked_time = 0
+        self._credit_blocked_since = None   # When the permitted data size ran out.
+
+    def readOutput(self, max_size):
+        """Read and decode up to max_size bytes of buffered data in one piece.
+
+        The permitted data size is reduced by the length of the returned text.
+        The result may be empty if the data ended part way through a character.
+        """
+        if not self.isAvailable():
+            return None
+        segments = self.buffer.consume(max_size)
+        self._buffer_start_time = self._last_read_time
+        text, text_length = self._decode(segments[0])
+        if len(segments) == 2:
+            more_text, more_length = self._decode(segments[1])
+            text += more_text
+            text_length += more_length
+        self._permit_data_size -= text_length
+        if len(text) != 0:
+            self.output_count += 1
+        self._refillFromSpool()
+        self._updateWatch()     # There may be room in the buffer again.
+        return text
+
+    def _decode(self, chunk):
+        """Decode as much of chunk as possible. Returns the text and its utf16_length()."""
+        # Most chunks don't follow a split sequence. Those are decoded directly
+        # from the buffer without first copying them onto the end of the pending bytes.
+        if len(self._undecoded) != 0:
+            chunk = self._undecoded + chunk
+        text, consumed = codecs.utf_8_decode(chunk, "ignore", False)
+        self._undecoded = bytes(chunk[consumed:])  # chunk may be a view of the buffer.
+        if len(text) == consumed:
+            return text, consumed   # One character per byte, so it is all ASCII.
+        return text, utf16_length(text)
+
+    def _availableCredit(self):
+        """How many more bytes may be read without being able to exceed the permitted data size.
+
+        Every byte of UTF-8 decodes to at most one UTF-16 code unit. Bytes
+        which are buffered or held by the decoder have to be reserved.
+        """
+        reserved = len(self.buffer) + len(self._undecoded)
+        return self._permit_data_size - reserved
+
+    def outputHoldDeadline(self):
+        """Return the time until which buffered output may be held back to coalesce it, or None to send now."""
+        if not self._streaming or len(self.buffer) >= OUTPUT_COALESCE_SIZE:
+            return None
+        if not self._isWatching():
+            return None     # No more data is coming.
+        deadline = self._buffer_start_time + OUTPUT_LATENCY_BUDGET
+        return deadline if deadline > time.monotonic() else None
 
     def isAvailable(self):
-        with self.buffer_lock:
-            return len(self.buffer) != 0
+        return self.buffer is not None and len(self.buffer) != 0
 
     def isEOF(self):
-        with self.buffer_lock:
-            return len(self.buffer)==0 and self._isEOF
+        return not self.isAvailable() and self._isEOF
 
     def permitDataSize(self, size):
         if LOG_FINER:
             log("NonblockingFileReader.permitDataSize(): Setting permit_data_size to " + str(size))
-        with self.buffer_lock:
-            self._permit_data_size = size
-            if size > 0:
-                self._read_valve.set()
+        self._permit_data_size = size
+        if size > 0 and self.buffer is None:
+            self.buffer = RingBuffer(PTY_BUFFER_SIZE)
+        if self._refillFromSpool() and self._activity_callback is not None:
+            self._activity_callback()
+        self._updateWatch()
+
+    def _isSpooling(self):
+        """True if output should be read into the spool.
+
+        Spooling starts once the permitted data size has been used up for
+        SPOOL_START_DELAY, and carries on while there is no permission and
+        the spool isn't empty. The spool is only emptied when permission
+        arrives again, so no output is dropped while the Extraterm side is
+        merely slow.
+        """
+        if self._spool_size == 0 or self._credit_blocked_since is None:
+            return False
+        if self._spool is not None and len(self._spool) != 0:
+            return True
+        return time.monotonic() - self._credit_blocked_since >= SPOOL_START_DELAY
+
+    def _refillFromSpool(self):
+        """Move spooled output into the buffer as far as the permitted data size allows.
+
+        Returns True if anything was moved.
+        """
+        if self._spool is None or len(self._spool) == 0:
+            return False
+        size = min(self.buffer.free(), len(self._spool))
+        if self._spool_size != 0:
+            size = min(size, self._availableCredit())
+        if size <= 0:
+            return False
+        for segment in self._spool.consume(size):
+            self.buffer.write(segment)
+        return True
+
+    def endSpooling(self):
+        """Stop spooling. What has been spooled is moved to the buffer without waiting for permission."""
+        self._spool_size = 0
+        self._refillFromSpool()
+
+    def spooledBytes(self):
+        return 0 if self._spool is None else len(self._spool)
+
+    def close(self):
+        """Stop watching the fd and throw away any spooled output."""
+        self._closed = True
+        if self._credit_blocked_since is not None:
+            self._credit_blocked_time += time.monotonic() - self._credit_blocked_since
+            self._credit_blocked_since = None
+        if self.fd is not None:
+            set_fd_callback(self.fd, selectors.EVENT_READ, None)
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+
+    def _isWatching(self):
+        if self._isEOF:
+            return False
+        if self._isSpooling():
+            return True
+        # Spooled output has to be sent before anything newer is read.
+        return self._availableCredit() > 0 and self.buffer.free() != 0 and self.spooledBytes() == 0
+
+    def creditBlockedTime(self):
+        """Total seconds spent unable to read because the permitted data size was used up."""
+        blocked_time = self._credit_blocked_time
+        if self._credit_blocked_since is not None:
+            blocked_time += time.monotonic() - self._credit_blocked_since
+        return blocked_time
+
+    def _updateWatch(self):
+        if self._closed:
+            return
+        blocked = self.buffer is not None and not self._isEOF and self._availableCredit() <= 0
+        if blocked != (self._credit_blocked_since is not None):
+            if blocked:
+                self._credit_blocked_since = time.monotonic()
+                if self._spool_size != 0:
+                    call_later(SPOOL_START_DELAY, self._updateWatch)
             else:
-                self._read_valve.clear()
+                self._credit_blocked_time += time.monotonic() - self._credit_blocked_since
+                self._credit_blocked_since = None
+        wanted = self.buffer is not None and self._isWatching()
+        if self.fd is None:
+            if wanted:
+                self._onReadable()
+        else:
+            set_fd_callback(self.fd, selectors.EVENT_READ, self._onReadable if wanted else None)
 
-    def _thread_start(self):
+    def _onReadable(self):
+        if self._isSpooling():
+            self._readIntoSpool()
+            return
+
+        max_size = min(PTY_READ_SIZE, self._availableCredit())
         try:
-            while True:
-                self._read_valve.wait()
-
-                chunk = self._read_next()
-                if LOG_FINER:
-                    log("NonblockingFileReader._thread_start() Read: " + repr(chunk))
-                
-                with self.buffer_lock:
-                    self.buffer.append(chunk)
-                    self.permitDataSize(self._permit_data_size - len(chunk))
-
-                # Tick the alarm
-                if LOG_FINER:
-                    log("NonblockingFileReader._thread_start() Setting activity flag.")
-                SignalIOActivity()
+            if self._custom_read is not None:
+                chunk = self._custom_read(min(max_size, self.buffer.free()))
+                count = self.buffer.write(chunk) if chunk else None
+            else:
+                count = self.buffer.readFromFd(self.fd, max_size)
         except EOFError:
             self._isEOF = True
             if LOG_FINE:
                 log("NonblockingFileReader got EOF, bye!")
-            SignalIOActivity()
-            
-    def _read_next(self):
-        if self._custom_read is not None:
-            return self._custom_read(1024)
-        else:
-            return self.file_object.read(10240)
+            self._updateWatch()
+            return
+
+        if LOG_FINER:
+            log("NonblockingFileReader._onReadable() Read: " + str(count) + " bytes")
+        if not count:
+            return  # Spurious wake up, nothing there to read.
+
+        self.bytes_read += count
+        self.read_count += 1
+        now = time.monotonic()
+        self._streaming = count >= OUTPUT_STREAMING_CHUNK_SIZE and \
+            now - self._last_read_time < OUTPUT_LATENCY_BUDGET
+        self._last_read_time = now
+        if len(self.buffer) == count:
+            self._buffer_start_time = now
+        if self._activity_callback is not None:
+            self._activity_callback()
+        self._updateWatch()
+
+    def _readIntoSpool(self):
+        if self._spool is None:
+            self._spool = Spool(self._spool_size)
+        self.spool_evicted_bytes += self._spool.makeRoom(PTY_READ_SIZE)
+        try:
+            count = self._spool.readFromFd(self.fd, PTY_READ_SIZE)
+        except EOFError:
+            self._isEOF = True
+            self._updateWatch()
+            return
+        if count:
+            self.bytes_read += count
+            self.read_count += 1
+
+
+CONTROL_READ_SIZE = 256 * 1024     # Bytes read from the control channel at a time.
 
 class NonblockingLineReader(NonblockingFileReader):
-    def __init__(self, file_object=None, read=None):
-        NonblockingFileReader.__init__(self, file_object=file_object, read=read)
-        self._read_valve.set()
+    """Reads complete lines from a non-blocking file descriptor."""
+    def __init__(self, fd):
+        NonblockingFileReader.__init__(self, fd=fd)
+        os.set_blocking(fd, False)
+        self._partial_line = b""
+        self.lines = []
+        set_fd_callback(self.fd, selectors.EVENT_READ, self._onReadable)
+
+    def readLines(self):
+        """Remove and return all of the complete lines read so far."""
+        lines = self.lines
+        self.lines = []
+        return lines
+
+    def isAvailable(self):
+        return len(self.lines) != 0
 
     def permitDataSize(self, size):
         pass
 
-    def _read_next(self):
-        return self.file_object.readline()
+    def _onReadable(self):
+        try:
+            data = os.read(self.fd, CONTROL_READ_SIZE)
+        except BlockingIOError:
+            return
+        if data == b"":
+            self._isEOF = True
+            if LOG_FINE:
+                log("NonblockingLineReader got EOF, bye!")
+            set_fd_callback(self.fd, selectors.EVENT_READ, None)
+            return
+
+        end = data.rfind(b"\n")
+        if end == -1:
+            self._partial_line += data
+            return
+        # Decode all of the complete lines in one go. A newline byte is never
+        # part of a multibyte UTF-8 sequence, so they split the same way.
+        text = (self._partial_line + data[:end]).decode("utf-8", errors="ignore")
+        self._partial_line = data[end+1:]
+        self.lines.extend(text.split("\n"))
 
 
 class NonblockingFileWriter:
-    def __init__(self, write):
+    def __init__(self, fd=None, write=None, activity_callback=None):
         global nbfr_counter
 
+        # fd is the file descriptor to watch for writability, `write` does the
+        # actual write and returns the number of bytes written, or None if it
+        # would block. fd may be None for writers which never block.
+        self.fd = fd
         self._write = write
+        # Called when a batch of strings has been completely written.
+        self._activity_callback = activity_callback
 
         self.id = nbfr_counter
         nbfr_counter += 1
-        
-        self._lock = threading.RLock()
+
         self.string_list = []
         self.chars_written_list = []
 
-        self._write_valve = threading.Event()
-        self._write_valve.clear()
-
-        self.thread = threading.Thread(name="Nonblocking File Writer "+str(self.id),
-            target=self._thread_start)
-        self.thread.daemon = True
-        self.thread.start()
-
-    def _thread_start(self):
-        try:
-            while True:
-                self._write_valve.wait()
-
-                while True:
-                    self._write_valve.clear()
-
-                    string = None
-                    with self._lock:
-                        if len(self.string_list) != 0:
-                            string = self.string_list[0]
-                            del self.string_list[0]
-
-                    if string is not None:
-                        if LOG_FINER:
-                            log("NonblockingFileWriter writing " + str(len(string)) + " chars")
-
-                        self._write(string.encode())
-
-                        with self._lock:
-                            # JavaScript strings have 16bit chars. Python strings have unicode code points.
-                            # Measure the length of the string in 16bit chars.
-                            self.chars_written_list.append(len(string.encode("utf_16_be"))//2)
-                        if LOG_FINER:
-                            log("NonblockingFileWriter._thread_start() Setting activity flag.")
-                        SignalIOActivity()
-                    else:
-                        break
-        except EOFError:
-            if LOG_FINE:
-                log("NonblockingFileWriter got EOF, bye!")
-            SignalIOActivity()
+        # The encoded batch currently being written. Its strings are credited
+        # in `chars_written_list` as the write gets past the end of each one,
+        # `_pending_ends` holds (end offset in the batch, length in 16bit chars).
+        self._pending_bytes = memoryview(b"")
+        self._pending_ends = collections.deque()
+        self._pending_offset = 0
+
+        # Counters for the stats command.
+        self.bytes_written = 0
+        self.write_count = 0
+
+    def _onWritable(self):
+        while True:
+            if len(self._pending_bytes) == self._pending_offset:
+                if len(self.string_list) == 0:
+                    break
+                self._startBatch()
+
+            try:
+                written = self._write(self._pending_bytes[self._pending_offset:])
+            except OSError as e:
+                if LOG_FINE:
+                    log("NonblockingFileWriter write failed, dropping pending data. " + str(e))
+                self._pending_bytes = memoryview(b"")
+                self._pending_ends.clear()
+                self._pending_offset = 0
+                self.string_list = []
+                break
+
+            if written is None:
+                return  # The pty is full. Wait until it becomes writable again.
+
+            self._pending_offset += written
+            self.bytes_written += written
+            self.write_count += 1
+            chars_written = 0
+            while len(self._pending_ends) != 0 and self._pending_ends[0][0] <= self._pending_offset:
+                chars_written += self._pending_ends.popleft()[1]
+            if chars_written != 0:
+                self.chars_written_list.append(chars_written)
+                if self._activity_callback is not None:
+                    self._activity_callback()
+
+        if self.fd is not None:
+            set_fd_callback(self.fd, selectors.EVENT_WRITE, None)
+
+    def _startBatch(self):
+        # Everything queued so far goes out as one batch. A paste arrives as
+        # many write messages and this turns them into a few large writes
+        # instead of one syscall per message.
+        encoded_list = []
+        end = 0
+        for string in self.string_list:
+            try:
+                encoded = string.encode()
+            except UnicodeEncodeError:
+                # A lone surrogate, from a surrogate pair which was split on the
+                # Extraterm side. Each one is written as a '?', which still
+                # counts as one UTF-16 code unit below.
+                encoded = string.encode("utf-8", "replace")
+            encoded_list.append(encoded)
+            end += len(encoded)
+            # JavaScript strings have 16bit chars. Python strings have unicode code points.
+            self._pending_ends.append((end, utf16_length_of_utf8(string, encoded)))
+        if LOG_FINER:
+            log("NonblockingFileWriter writing " + str(len(self.string_list)) + " strings, " + str(end) + " bytes")
+        self.string_list = []
+        self._pending_bytes = memoryview(b"".join(encoded_list))
+        self._pending_offset = 0
 
     def write(self, string):
         if LOG_FINE:
             log("NonblockingFileWriter write()")
-        with self._lock:
-            self.string_list.append(string)
-            self._write_valve.set()
+        self.string_list.append(string)
+        if self.fd is None:
+            self._onWritable()
+        else:
+            set_fd_callback(self.fd, selectors.EVENT_WRITE, self._onWritable)
+            if self.queuedBytes() == 0:
+                # Not waiting on a full pty, so the write can be tried straight away.
+                unflushed_writers.add(self)
+
+    def close(self):
+        unflushed_writers.discard(self)
+        if self.fd is not None:
+            set_fd_callback(self.fd, selectors.EVENT_WRITE, None)
+
+    def queuedBytes(self):
+        """Bytes of the current batch still to be written. Queued strings are not included."""
+        return len(self._pending_bytes) - self._pending_offset
 
     def nextCharsWritten(self):
-        with self._lock:
-            if len(self.chars_written_list) == 0:
-                return None
-            else:
-                chars_written = self.chars_written_list[0]
-                del self.chars_written_list[0]
-                return chars_written
+        if len(self.chars_written_list) == 0:
+            return None
+        else:
+            chars_written = self.chars_written_list[0]
+            del self.chars_written_list[0]
+            return chars_written
 
+unflushed_writers = set()   # Writers given data since flush_writers() was last called.
 
-def SignalIOActivity():
-    activity_event.set()
+def flush_writers():
+    """Start writing the data from this pass's write commands without waiting for the next select().
 
-def WaitOnIOActivity():
-    global activity_event
-    if LOG_FINER:
-        log("activity_event.wait()")
-    activity_event.wait()
+    Keystrokes reach the pty, and their echo comes back, one loop iteration
+    sooner. All of the strings queued in the pass still go out as one batch.
+    """
+    writers = list(unflushed_writers)
+    unflushed_writers.clear()
+    for writer in writers:
+        writer._onWritable()
+
+
+###########################################################################
+# Timers run from the main loop. Entries are (deadline, sequence, callback).
+timer_heap = []
+timer_sequence = itertools.count()
+
+def call_later(delay, callback):
+    heapq.heappush(timer_heap, (time.monotonic() + delay, next(timer_sequence), callback))
+
+def next_timer_timeout():
+    """Seconds until the next timer is due, or None if there are no timers."""
+    if len(timer_heap) == 0:
+        return None
+    return max(0, timer_heap[0][0] - time.monotonic())
+
+def run_due_timers():
+    now = time.monotonic()
+    while len(timer_heap) != 0 and timer_heap[0][0] <= now:
+        deadline, sequence, callback = heapq.heappop(timer_heap)
+        callback()
+
+
+def WaitOnIOActivity(timeout=None):
+    """Block until at least one fd is ready and run the callbacks for all ready fds."""
     if LOG_FINER:
-        log("activity_event.clear()")
-    activity_event.clear()
+        log("selector.select()")
+    for key, mask in selector.select(timeout):
+        read_callback, write_callback = key.data
+        if mask & selectors.EVENT_READ and read_callback is not None:
+            read_callback()
+        # The read callback may have cleared the write interest.
+        write_callback = key.data[1]
+        if mask & selectors.EVENT_WRITE and write_callback is not None:
+            write_callback()
+
+###########################################################################
+# Child exit detection
+#
+# Rather than polling every pty with isalive() after each wake up, exits are
+# signalled through the selector. On Linux 5.3+ each child gets a pidfd which
+# becomes readable when it exits. Elsewhere (e.g. Cygwin) a SIGCHLD handler
+# wakes the selector via signal.set_wakeup_fd() and every pty is checked once.
+
+exit_check_ids = set()  # IDs of ptys whose child may have exited.
+use_pidfd = False
+sigchld_read_fd = None
+
+def init_child_exit_detection():
+    global use_pidfd
+    global sigchld_read_fd
+
+    if hasattr(os, "pidfd_open"):
+        try:
+            os.close(os.pidfd_open(os.getpid()))
+            use_pidfd = True
+        except OSError:
+            pass
+
+    if use_pidfd:
+        if LOG_FINE:
+            log("Using pidfd for child exit detection.")
+        return
+
+    if LOG_FINE:
+        log("Using SIGCHLD for child exit detection.")
+    sigchld_read_fd, write_fd = os.pipe()
+    os.set_blocking(sigchld_read_fd, False)
+    os.set_blocking(write_fd, False)
+    signal.set_wakeup_fd(write_fd)
+    # A Python level handler must be installed for the wakeup fd to be written.
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    set_fd_callback(sigchld_read_fd, selectors.EVENT_READ, _on_sigchld)
+
+def _on_sigchld():
+    try:
+        while os.read(sigchld_read_fd, 1024):
+            pass
+    except BlockingIOError:
+        pass
+    # We don't know which child exited, check them all.
+    exit_check_ids.update(pty_sessions.keys())
+
+def watch_child_exit(pty_id, pty):
+    """Start watching for the exit of a pty's child process.
+
+    Returns the pidfd being watched, or None.
+    """
+    if not use_pidfd or getattr(pty, "pid", None) is None:
+        return None
+    try:
+        pidfd = os.pidfd_open(pty.pid)
+    except OSError:
+        # The child may already be gone.
+        exit_check_ids.add(pty_id)
+        return None
+
+    def on_exit():
+        set_fd_callback(pidfd, selectors.EVENT_READ, None)
+        exit_check_ids.add(pty_id)
+
+    set_fd_callback(pidfd, selectors.EVENT_READ, on_exit)
+    return pidfd
+
+def release_pty_session(session):
+    """Stop watching a pty's fds and close them."""
+    session.reader.close()
+    session.writer.close()
+
+    exit_watch_fd = session.exit_watch_fd
+    if exit_watch_fd is not None:
+        set_fd_callback(exit_watch_fd, selectors.EVENT_READ, None)
+        os.close(exit_watch_fd)
+        session.exit_watch_fd = None
+
+    pty = session.pty
+    if isinstance(pty, ptyprocess.PtyProcess) and not pty.closed:
+        # PtyProcess.close() would sleep and try to terminate the already dead child.
+        pty.fileobj.close()
+        pty.fd = -1
+        pty.closed = True
+
+def drain_pty_output(session):
+    """Read whatever output is immediately available from an exited pty.
+
+    Spooled output is sent as well, without waiting for permission to send it.
+    """
+    reader = session.reader
+    if reader.fd is None:
+        return
+    while reader._isSpooling() and not reader._isEOF:
+        bytes_read = reader.bytes_read
+        try:
+            reader._readIntoSpool()
+        except OSError:
+            break
+        if reader.bytes_read == bytes_read:
+            break
+    reader.endSpooling()
+    while True:
+        if reader.buffer is not None and reader._isWatching():
+            buffer_len = len(reader.buffer)
+            try:
+                reader._onReadable()
+            except OSError:
+                pass
+            if len(reader.buffer) == buffer_len and not reader.isAvailable():
+                break
+        data = reader.readOutput(OUTPUT_COALESCE_SIZE)
+        if data is None:
+            break
+        if data != "":
+            send_output_to_controller(session.id, data)
+
+###########################################################################
+# Terminating ptys
+#
+# PtyProcess.terminate() sleeps between each signal it sends, freezing every
+# other session. Instead the signals are sent from timers and we stop as soon
+# as the exit detection above has closed the pty.
+
+TERMINATE_SIGNALS = [signal.SIGHUP, signal.SIGCONT, signal.SIGINT, signal.SIGKILL]
+TERMINATE_STEP_DELAY = 0.1  # Seconds to wait for the child to exit after each signal.
+
+def terminate_pty_async(session):
+    if session.terminating:
+        return
+    session.terminating = True
+
+    pty = session.pty
+    if not isinstance(pty, ptyprocess.PtyProcess):
+        pty.terminate(True)
+        exit_check_ids.add(session.id)
+        return
+
+    remaining_signals = list(TERMINATE_SIGNALS)
+
+    def next_step():
+        if pty.closed:
+            return  # Exit was detected and the pty has been released.
+        # Also make sure that an exit can't slip past a missed signal.
+        exit_check_ids.add(session.id)
+        if len(remaining_signals) == 0:
+            log("Could not terminate the child process of pty (id=" + str(session.id) + ")")
+            return
+        sig = remaining_signals.pop(0)
+        if LOG_FINE:
+            log("Sending signal " + str(sig) + " to pty (id=" + str(session.id) + ")")
+        try:
+            os.kill(pty.pid, sig)
+        except ProcessLookupError:
+            return
+        call_later(TERMINATE_STEP_DELAY, next_step)
+
+    next_step()
+
+###########################################################################
+
+class PtySession:
+    __slots__ = ("id", "pty", "reader", "writer", "exit_watch_fd", "terminating", "last_input_time",
+        "output_deficit", "process", "size", "pending_size", "resize_time")
+
+    def __init__(self, pty_id, pty, reader, writer):
+        self.id = pty_id
+        self.pty = pty
+        self.reader = reader
+        self.writer = writer
+        self.exit_watch_fd = None
+        self.terminating = False
+        self.last_input_time = None    # When the session was last written to.
+        self.output_deficit = 0         # Bytes left of its bulk output turn.
+        self.process = None     # (pid, name, cwd) of the foreground process when it was last sampled.
+        self.size = None        # (rows, columns) last given to the pty.
+        self.pending_size = None    # (rows, columns) waiting to be applied by a timer.
+        self.resize_time = 0    # When the pty was last resized.
+
+pty_sessions = {}   # Maps pty ID to PtySession.
+active_session_ids = set()  # IDs of sessions with buffered output or output-written counts.
+
+###########################################################################
+# Resizing
+#
+# Every resize of a pty sends SIGWINCH and makes full screen programs redraw.
+# Dragging a window edge produces a stream of resizes, so a pty is resized at
+# most once every RESIZE_COALESCE_INTERVAL. A resize arriving sooner than that
+# waits on a timer and only the latest size is applied when it fires.
+
+RESIZE_COALESCE_INTERVAL = 0.05    # Minimum seconds between resizes of one pty.
+
+def resize_session(session, rows, columns):
+    if session.pending_size is not None:
+        session.pending_size = (rows, columns)     # The timer will apply it.
+        return
+    delay = session.resize_time + RESIZE_COALESCE_INTERVAL - time.monotonic()
+    if delay <= 0:
+        apply_session_size(session, (rows, columns))
+        return
+    session.pending_size = (rows, columns)
+    call_later(delay, lambda: apply_pending_size(session))
+
+def apply_pending_size(session):
+    size = session.pending_size
+    session.pending_size = None
+    if pty_sessions.get(session.id) is session:
+        apply_session_size(session, size)
+
+def apply_session_size(session, size):
+    if size == session.size:
+        return
+    if LOG_FINE:
+        log("Resizing pty (id=" + str(session.id) + ") to " + repr(size))
+    session.size = size
+    session.resize_time = time.monotonic()
+    session.pty.setwinsize(*size)
 
 ###########################################################################
+# Output scheduling
+#
+# Sessions which were written to recently are probably being typed in. Their
+# output is sent first in each pass and flushed straight away, so that echo
+# doesn't wait behind the output of busy sessions. The other, bulk, sessions
+# take turns using deficit round robin, which shares out bytes rather than
+# messages evenly. While there are interactive sessions, a pass which has sent
+# BULK_PASS_BUDGET bytes of bulk output stops, and the main loop checks for new
+# input and echo before carrying on where it stopped.
+
+INTERACTIVE_INPUT_WINDOW = 1.0      # Seconds after a write during which a session counts as interactive.
+BULK_OUTPUT_QUANTUM = OUTPUT_COALESCE_SIZE      # Bytes of output a bulk session may send per turn.
+BULK_PASS_BUDGET = 2 * OUTPUT_COALESCE_SIZE     # Bytes of bulk output sent per pass.
+
+bulk_next_id = 0    # The bulk session whose turn is next.
+
+def is_interactive(session, now):
+    return session.last_input_time is not None and now - session.last_input_time < INTERACTIVE_INPUT_WINDOW
+
+def send_session_output(session, max_size):
+    """Send up to max_size bytes of a session's buffered output in one message.
+
+    Returns the number of bytes consumed.
+    """
+    reader = session.reader
+    buffer_len = len(reader.buffer)
+    data = reader.readOutput(max_size)
+    if LOG_FINE:
+        log("server <<< pty : " + repr(data))
+    if data != "":
+        send_output_to_controller(session.id, data)
+        if process_tracking:
+            mark_for_process_sample(session.id)
+    return buffer_len - len(reader.buffer)
+
+def send_chars_written(session):
+    writer = session.writer
+    total_chars_written = 0
+    next_chars_written = writer.nextCharsWritten()
+    while next_chars_written is not None:
+        total_chars_written += next_chars_written
+        next_chars_written = writer.nextCharsWritten()
+
+    if total_chars_written != 0:
+        send_to_controller( {"type": "output-written", "id": session.id, "chars": total_chars_written} )
+
+def schedule_output():
+    """Send output from the active sessions for one pass of the main loop.
+
+    Returns (sent, budget_spent, hold_deadline). hold_deadline is the earliest
+    time when output which is being held back to coalesce it should be sent.
+    """
+    global bulk_next_id
+
+    now = time.monotonic()
+    sent = False
+    hold_deadline = None
+    bulk_ids = []
+    interactive_count = 0
+    for pty_id in list(active_session_ids):
+        session = pty_sessions.get(pty_id)
+        if session is None:
+            active_session_ids.discard(pty_id)
+            continue
+
+        send_chars_written(session)
+        if not session.reader.isAvailable():
+            active_session_ids.discard(pty_id)
+            continue
+        if not is_interactive(session, now):
+            bulk_ids.append(pty_id)
+            continue
+        interactive_count += 1
+
+        while session.reader.isAvailable():
+            session_deadline = session.reader.outputHoldDeadline()
+            if session_deadline is not None:
+                hold_deadline = session_deadline if hold_deadline is None else min(hold_deadline, session_deadline)
+                break
+            send_session_output(session, OUTPUT_COALESCE_SIZE)
+            sent = True
+
+    if sent:
+        flush_controller()
+
+    # Carry on the round robin from the session after the last one served.
+    bulk_ids.sort()
+    start = 0
+    while start < len(bulk_ids) and bulk_ids[start] < bulk_next_id:
+        start += 1
+    # Without anyone typing there's no need to cut passes short.
+    budget = BULK_PASS_BUDGET if interactive_count != 0 else sys.maxsize
+    for pty_id in bulk_ids[start:] + bulk_ids[:start]:
+        if budget <= 0:
+            bulk_next_id = pty_id
+            return sent, True, hold_deadline
+
+        session = pty_sessions[pty_id]
+        if session.output_deficit <= 0:
+            session.output_deficit += BULK_OUTPUT_QUANTUM
+        while budget > 0 and session.output_deficit > 0 and session.reader.isAvailable():
+            session_deadline = session.reader.outputHoldDeadline()
+            if session_deadline is not None:
+                hold_deadline = session_deadline if hold_deadline is None else min(hold_deadline, session_deadline)
+                break
+            consumed = send_session_output(session, min(OUTPUT_COALESCE_SIZE, session.output_deficit))
+            sent = True
+            session.output_deficit -= consumed
+            budget -= consumed
+
+        if not session.reader.isAvailable():
+            session.output_deficit = 0
+        if session.output_deficit > 0 and budget <= 0:
+            bulk_next_id = pty_id   # Finish its turn first next time.
+            return sent, True, hold_deadline
+        bulk_next_id = pty_id + 1
+
+    return sent, False, hold_deadline
 
-pty_list = []   # List of dicts with structure {id: string, pty: pty, reader: }
+###########################################################################
+# Warm pool
+#
+# Ptys for one profile (argv, environment and cwd) can be spawned ahead of
+# time, so that the shell has already run its startup files when a create
+# command for the same profile arrives. The pool is refilled from timers,
+# one pty at a time, and ptys which have waited longer than the TTL are
+# replaced so that shells don't sit around for ever with stale state.
+# Environments are compared in full, a pty is never handed out with an
+# environment which differs from the one asked for.
+
+POOL_DEFAULT_TTL = 600.0
+POOL_SPAWN_INTERVAL = 0.1   # Seconds between spawning ptys to refill the pool.
+
+class PoolProfile:
+    __slots__ = ("key", "argv", "env", "cwd", "rows", "columns", "size", "ttl")
+
+    def __init__(self, argv, env, cwd, rows, columns, size, ttl):
+        self.key = pool_key(argv, env, cwd)
+        self.argv = argv
+        self.env = env
+        self.cwd = cwd
+        self.rows = rows
+        self.columns = columns
+        self.size = size
+        self.ttl = ttl
+
+def pool_key(argv, env, cwd):
+    return (tuple(argv), tuple(sorted(env.items())), cwd)
+
+pool_profile = None
+pool_ptys = collections.deque()  # (spawn time, PtyProcess), oldest first.
+pool_generation = 0     # Bumped to cancel previously scheduled pool maintenance.
+pool_reported_size = 0  # Ready ptys last reported to the front in sharded mode.
+
+def configure_pool(profile):
+    """Set the profile to keep ptys ready for, or None to empty the pool."""
+    global pool_profile
+
+    if profile is None or pool_profile is None or profile.key != pool_profile.key:
+        while len(pool_ptys) != 0:
+            discard_pooled_pty(pool_ptys.popleft()[1])
+    pool_profile = profile
+    if profile is not None:
+        if LOG_FINE:
+            log("Keeping " + str(profile.size) + " ptys ready for " + repr(profile.argv))
+        schedule_pool_maintenance(0)
+    report_pool_size()
+
+def report_pool_size():
+    """Tell the front how many ptys are ready, so it can send matching creates here."""
+    global pool_reported_size
+    if worker_mode and len(pool_ptys) != pool_reported_size:
+        pool_reported_size = len(pool_ptys)
+        send_to_front({"type": "pool", "ready": pool_reported_size})
+
+def claim_pooled_pty(argv, env, cwd):
+    """Take a ready pty for this argv, env and cwd out of the pool, or return None."""
+    if pool_profile is None or pool_key(argv, env, cwd) != pool_profile.key:
+        return None
+
+    pty = None
+    while len(pool_ptys) != 0:
+        candidate = pool_ptys.popleft()[1]
+        if candidate.isalive():
+            pty = candidate
+            break
+        discard_pooled_pty(candidate)
+    schedule_pool_maintenance(POOL_SPAWN_INTERVAL)
+    report_pool_size()
+    if LOG_FINE:
+        log("Claimed pty from the pool" if pty is not None else "The pool is empty")
+    return pty
+
+def schedule_pool_maintenance(delay):
+    global pool_generation
+    pool_generation += 1
+    generation = pool_generation
+    call_later(delay, lambda: maintain_pool(generation))
+
+def maintain_pool(generation):
+    if generation != pool_generation or pool_profile is None:
+        return
+
+    # Replace ptys which have waited too long or whose shell has gone.
+    now = time.monotonic()
+    for entry in list(pool_ptys):
+        spawn_time, pty = entry
+        if now - spawn_time >= pool_profile.ttl or not pty.isalive():
+            pool_ptys.remove(entry)
+            discard_pooled_pty(pty)
+    while len(pool_ptys) > pool_profile.size:
+        discard_pooled_pty(pool_ptys.popleft()[1])
+
+    if len(pool_ptys) < pool_profile.size:
+        try:
+            pty = ptyprocess.PtyProcess.spawn(pool_profile.argv, dimensions=(pool_profile.rows, pool_profile.columns),
+                env=pool_profile.env, cwd=pool_profile.cwd, resolve_absolute=False)
+        except OSError as e:
+            log("Unable to spawn a pty for the pool. " + str(e))
+            configure_pool(None)
+            return
+        pool_ptys.append((time.monotonic(), pty))
+        schedule_pool_maintenance(POOL_SPAWN_INTERVAL)
+    else:
+        schedule_pool_maintenance(max(0, pool_ptys[0][0] + pool_profile.ttl - now))
+    report_pool_size()
+
+def discard_pooled_pty(pty):
+    """Close a pty from the pool and make sure that its child exits and is reaped."""
+    if not pty.closed:
+        pty.fileobj.close()     # Hangs up the shell.
+        pty.fd = -1
+        pty.closed = True
+
+    # Pooled ptys aren't watched for exits, so check on the child from timers.
+    remaining_signals = list(TERMINATE_SIGNALS)
+
+    def next_step():
+        try:
+            if not pty.isalive():
+                return
+        except ptyprocess.PtyProcessError:
+            return
+        if len(remaining_signals) == 0:
+            log("Could not terminate the child process of a pooled pty (pid=" + str(pty.pid) + ")")
+            return
+        try:
+            os.kill(pty.pid, remaining_signals.pop(0))
+        except ProcessLookupError:
+            pass
+        call_later(TERMINATE_STEP_DELAY, next_step)
+
+    call_later(TERMINATE_STEP_DELAY, next_step)
+
+###########################################################################
+# Process tracking
+#
+# With processTracking turned on by the configure command, the server follows
+# the foreground process group of each pty and pushes a process-changed
+# message when its leader, command name or working directory changes.
+#
+# Sessions which send output or are written to are marked, and the marked
+# sessions are sampled together in one pass. Passes run a moment after the
+# first mark, giving a command time to start or a cd time to finish, and at
+# most once every PROCESS_SAMPLE_INTERVAL. Idle sessions are never looked at.
+# A foreground process rarely changes silently, a shell at least prints a new
+# prompt after a command or a cd.
+
+PROCESS_SAMPLE_DELAY = 0.05        # Seconds from the first mark to the sampling pass.
+PROCESS_SAMPLE_INTERVAL = 0.25     # Minimum seconds between sampling passes.
+
+process_tracking = False
+process_sample_ids = set()  # IDs of sessions to look at in the next sampling pass.
+process_sample_pending = False
+process_sample_time = 0     # When the last sampling pass ran.
+
+def mark_for_process_sample(pty_id):
+    global process_sample_pending
+    process_sample_ids.add(pty_id)
+    if not process_sample_pending:
+        process_sample_pending = True
+        delay = max(PROCESS_SAMPLE_DELAY, process_sample_time + PROCESS_SAMPLE_INTERVAL - time.monotonic())
+        call_later(delay, sample_processes)
+
+def read_process_info(pid):
+    """Read the command name and working directory of a process from /proc.
+
+    Returns (name, cwd), or None if the process has gone or /proc is missing.
+    The name is None if it can't be read.
+    """
+    proc_dir = "/proc/" + str(pid)
+    try:
+        cwd = os.readlink(proc_dir + "/cwd")
+    except OSError:
+        return None
+    return read_process_name(proc_dir), cwd
+
+def read_process_name(proc_dir):
+    # Cygwin doesn't always have comm, the stat file has the name too.
+    try:
+        with open(proc_dir + "/comm", "rb") as comm_file:
+            return comm_file.read().decode("utf-8", "replace").rstrip("\n")
+    except OSError:
+        pass
+    try:
+        with open(proc_dir + "/stat", "rb") as stat_file:
+            stat = stat_file.read().decode("utf-8", "replace")
+    except OSError:
+        return None
+    start = stat.find("(")
+    end = stat.rfind(")")
+    if start == -1 or end < start:
+        return None
+    return stat[start+1:end]
+
+def sample_session_process(session):
+    """Find the foreground process of a session.
+
+    Returns (pid, name, cwd), or None if it can't be found.
+    """
+    pty = session.pty
+    if not isinstance(pty, ptyprocess.PtyProcess) or pty.closed:
+        return None
+    try:
+        pid = os.tcgetpgrp(pty.fd)    # The process group leader's pid is the group ID.
+    except OSError:
+        pid = pty.pid
+    info = read_process_info(pid)
+    if info is None and pid != pty.pid:
+        # The group leader has already exited.
+        pid = pty.pid
+        info = read_process_info(pid)
+    if info is None:
+        return None
+    return (pid,) + info
+
+def sample_processes():
+    global process_sample_pending
+    global process_sample_time
+    process_sample_pending = False
+    process_sample_time = time.monotonic()
+    sample_ids = list(process_sample_ids)
+    process_sample_ids.clear()
+    for pty_id in sample_ids:
+        session = pty_sessions.get(pty_id)
+        if session is None:
+            continue
+        process = sample_session_process(session)
+        if process is None or process == session.process:
+            continue
+        session.process = process
+        pid, name, cwd = process
+        send_to_controller({"type": "process-changed", "id": pty_id, "pid": pid, "name": name, "cwd": cwd})
 
 #
 #
@@ -230,8 +1246,17 @@ pty_list = []   # List of dicts with structure {id: string, pty: pty, reader: }
 #   columns: number;
 #   env?: {string: string};  // dict
 #   extraEnv?: {string: string}
+#   cwd?: string;
+#   spoolSize?: number;     // Bytes of output to spool while the permitted data size is used up.
 # }
 #
+# With a spoolSize, output which arrives after the permitted data size has run
+# out for a while is kept in a spool, dropping the oldest output when it is
+# full. It is sent as permission arrives, and all at once if the command exits.
+#
+# A create command is served from the warm pool (see below) if the pool
+# holds a pty with exactly the same argv, environment and cwd.
+#
 # Created message (to Extraterm process):
 # {
 #   type: string = "created";
@@ -267,6 +1292,15 @@ pty_list = []   # List of dicts with structure {id: string, pty: pty, reader: }
 #   columns: number;
 # }
 #
+# resize many message (from Extraterm process, if configured says resizeMany)
+# {
+#   type: string = "resize-many";
+#   sizes: { id: number; rows: number; columns: number; }[];
+# }
+#
+# Resizes of one pty which follow each other quickly are merged and only the
+# latest size is applied.
+#
 # terminate (from Extraterm process)
 # {
 #   type: string = "terminate";
@@ -278,45 +1312,192 @@ pty_list = []   # List of dicts with structure {id: string, pty: pty, reader: }
 #   id: number; // pty ID.
 #   size: number; // permitted number of characters to send.
 # }
+#
+# pool (from Extraterm process, optional)
+# {
+#   type: string = "pool";
+#   size: number;       // Number of ptys to keep ready. 0 empties the pool.
+#   argv: string[];     // argv, env, extraEnv and cwd are the same as for create.
+#   env?: {string: string};
+#   extraEnv?: {string: string}
+#   cwd?: string;
+#   rows?: number;      // Size to start the ptys at. They are resized when claimed.
+#   columns?: number;
+#   ttl?: number;       // Seconds a pty may wait in the pool before being replaced.
+# }
+#
+# get working directory (from Extraterm process)
+# {
+#   type: string = "get-working-directory";
+#   id: number; // pty ID.
+# }
+#
+# working directory message (to Extraterm process, the reply to get-working-directory)
+# {
+#   type: string = "working-directory";
+#   id: number; // pty ID.
+#   cwd: string | null; // Of the foreground process, or null if it can't be found.
+# }
+#
+# process changed message (to Extraterm process, only with processTracking)
+# {
+#   type: string = "process-changed";
+#   id: number;     // pty ID.
+#   pid: number;    // Foreground process group leader.
+#   name: string | null;   // Its command name, if it can be found.
+#   cwd: string;    // Its working directory.
+# }
+#
+# stats (from Extraterm process)
+# {
+#   type: string = "stats";
+# }
+#
+# stats message (to Extraterm process, the reply to stats)
+# {
+#   type: string = "stats";
+#   wakeups: number;            // Times the main loop has woken up.
+#   wakeupsPerSecond: number;   // Since the previous stats command, or the start.
+#   sessions: {
+#     id: number;               // pty ID.
+#     bytesRead: number;        // Read from the pty.
+#     reads: number;            // Reads which returned data.
+#     outputMessages: number;   // Output messages sent.
+#     creditBlockedTime: number; // Seconds with the permitted data size used up.
+#     bufferedBytes: number;    // Read but not sent yet.
+#     spooledBytes: number;     // Waiting in the spool.
+#     spoolEvictedBytes: number; // Dropped from a full spool.
+#     bytesWritten: number;     // Written to the pty.
+#     writes: number;           // Writes which accepted data.
+#     queuedWrites: number;     // Strings waiting to be written.
+#     queuedWriteBytes: number; // Bytes of the current write batch still to be written.
+#   }[];
+# }
+#
+# configure (from Extraterm process, optional and sent before anything else)
+# {
+#   type: string = "configure";
+#   framing?: string;   // "json" (default) or "binary".
+#   compression?: string;   // "none" (default) or "zlib".
+#   processTracking?: boolean;  // Send process-changed messages. Default false.
+# }
+#
+# configured message (to Extraterm process, sent in the old framing and compression)
+# {
+#   type: string = "configured";
+#   framing: string;    // The framing used for everything sent after this.
+#   compression: string;    // The compression used for everything sent after this.
+#   resizeMany: boolean;    // The resize-many command is understood.
+# }
+#
+# By default each message to the Extraterm process is a line of UTF-8 JSON.
+# Non-ASCII characters in strings are not escaped. Output data is always
+# split between characters, never inside one. With "binary" framing each
+# message is a frame made of a header followed by a payload:
+#
+#   frame type: uint8
+#   pty ID: uint32, big endian. Only used by output frames, 0 otherwise.
+#   payload length: uint32, big endian.
+#
+# Frame type 0 carries a message as UTF-8 JSON. Frame type 1 is the
+# equivalent of an output message and the payload is the output data as
+# UTF-8 text.
+#
+# With "zlib" compression everything after the configured message is one
+# zlib stream (RFC 1950). It is sync flushed at the end of each main loop
+# pass, so the data sent so far can always be decompressed completely.
+# One context is used for the whole stream, so repeated color sequences,
+# prompts and log prefixes compress well even across messages. Once turned
+# on, compression stays on.
+
+FRAMING_JSON = "json"
+FRAMING_BINARY = "binary"
+
+FRAME_TYPE_MESSAGE = 0
+FRAME_TYPE_OUTPUT = 1
+frame_header = struct.Struct(">BII")
+
+COMPRESSION_NONE = "none"
+COMPRESSION_ZLIB = "zlib"
+COMPRESSION_LEVEL = 1
+
+class ZlibWriter:
+    """Compresses what is written to it into one zlib stream, sync flushed on each flush()."""
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._compressor = zlib.compressobj(COMPRESSION_LEVEL)
+        self._pending = []
+
+    def write(self, data):
+        # Messages are written in small pieces. They are compressed together on flush.
+        self._pending.append(bytes(data))
+
+    def flush(self):
+        if len(self._pending) != 0:
+            compressed = self._compressor.compress(b"".join(self._pending))
+            self._pending = []
+            self._raw.write(compressed + self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        self._raw.flush()
+
+controller_framing = FRAMING_JSON
+controller_compression = COMPRESSION_NONE
+controller_out = sys.stdout.buffer
 
 pty_counter = 1
 
 def process_command(json_command):
     if LOG_FINE:
         log("server process command:" + repr(json_command))
-    cmd = json.loads(json_command)
-    cmd_type = cmd["type"]
+    return dispatch_command(json.loads(json_command), json_command)
 
-    if cmd_type == "create":
-        return process_create_command(cmd)
-    if cmd_type == "write":
-        return process_write_command(cmd)
-    if cmd_type == "resize":
-        return process_resize_command(cmd)
-    if cmd_type == "permit-data-size":
-        return process_permit_data_size_command(cmd)
-    if cmd_type == "close":
-        return process_close_command(cmd)
-    if cmd_type == "terminate":
-        return process_terminate_command(cmd)
-        
-    log("ptyserver receive unrecognized message:" + json_command)
-    return True
+def dispatch_command(cmd, json_command):
+    handler = command_handlers.get(cmd["type"])
+    if handler is None:
+        log("ptyserver receive unrecognized message:" + json_command)
+        return True
+    return handler(cmd)
 
-def process_create_command(cmd):
-    global pty_list
-    global pty_counter
-    
-    # Create a new pty.
-    rows = cmd["rows"]
-    columns = cmd["columns"]
+def process_commands(json_commands):
+    """Process a batch of command lines. Returns False if the server should stop.
+
+    Runs of write commands for the same pty, e.g. from a paste, are merged
+    and given to the pty's writer as one string.
+    """
+    running = True
+    write_cmd = None    # A write command which the following writes to the same pty are merged into.
+    write_data = []
+    for json_command in json_commands:
+        if LOG_FINE:
+            log("server process command:" + repr(json_command))
+        cmd = json.loads(json_command)
+        is_write = cmd["type"] == "write"
+        if write_cmd is not None:
+            if is_write and cmd["id"] == write_cmd["id"]:
+                write_data.append(cmd["data"])
+                continue
+            write_cmd["data"] = "".join(write_data)
+            running = process_write_command(write_cmd) and running
+            write_cmd = None
+        if is_write:
+            write_cmd = cmd
+            write_data = [cmd["data"]]
+        else:
+            running = dispatch_command(cmd, json_command) and running
+    if write_cmd is not None:
+        write_cmd["data"] = "".join(write_data)
+        running = process_write_command(write_cmd) and running
+    return running
+
+def session_spawn_args(cmd):
+    """Work out the argv, env and cwd to spawn for a create or pool command."""
     env = cmd.get("env", None)
     if env is None:
-        env = {key: value for key, value in os.environ.items()}
+        env = dict(get_base_environment())
 
     env.update(cmd.get("extraEnv", {}))
 
-    cwd = cmd["cwd"]
+    cwd = cmd.get("cwd", None)
     if cwd == "" or cwd is None:
         cwd = None
     else:
@@ -329,107 +1510,565 @@ def process_create_command(cmd):
             env["PATH"] = env["Path"]
             del env["Path"]
         env["PATH"] = cygwin_convert_path_variable(env["PATH"])
-    try:
-        pty = ptyprocess.PtyProcess.spawn(cmd["argv"], dimensions=(rows, columns), env=env, cwd=cwd)
-    except FileNotFoundError:
-        pty = DeadPty(cmd["argv"])
-
-    pty_reader = NonblockingFileReader(read=pty.read)
-    pty_writer = NonblockingFileWriter(write=pty.write)
-
-    pty_id = pty_counter
-    pty_list.append({
-        "id": pty_id,
-        "pty": pty,
-        "reader": pty_reader,
-        "readDecoder": codecs.lookup("utf8").incrementaldecoder(errors="ignore"),
-        "writer": pty_writer})
+    return cmd["argv"], env, cwd
+
+def process_create_command(cmd):
+    global pty_counter
+    
+    # Create a new pty.
+    rows = cmd["rows"]
+    columns = cmd["columns"]
+    argv, env, cwd = session_spawn_args(cmd)
+
+    pty = claim_pooled_pty(argv, env, cwd)
+    if pty is not None:
+        pty.setwinsize(rows, columns)
+    else:
+        try:
+            pty = ptyprocess.PtyProcess.spawn(argv, dimensions=(rows, columns), env=env, cwd=cwd,
+                resolve_absolute=False)
+        except OSError:     # Not found, not executable, or an absolute path which failed to exec.
+            pty = DeadPty(argv)
+
+    pty_fd = getattr(pty, "fd", None)
+    if pty_fd is not None:
+        os.set_blocking(pty_fd, False)
+    pty_id = cmd.get("assignedId", pty_counter)    # Sharded mode workers are given the ID.
+    mark_active = lambda: active_session_ids.add(pty_id)
+    spool_size = cmd.get("spoolSize", 0) if pty_fd is not None else 0
+    if spool_size > 0:
+        spool_size = max(spool_size, PTY_READ_SIZE)
+    pty_reader = NonblockingFileReader(fd=pty_fd, read=pty.read if pty_fd is None else None,
+        activity_callback=mark_active, spool_size=spool_size)
+    pty_writer = NonblockingFileWriter(fd=pty_fd, write=pty.write, activity_callback=mark_active)
+
+    session = PtySession(pty_id, pty, pty_reader, pty_writer)
+    session.size = (rows, columns)
+    session.exit_watch_fd = watch_child_exit(pty_id, pty)
+    pty_sessions[pty_id] = session
     pty_counter += 1
     
     send_to_controller({ "type": "created", "id": pty_id })
+    if process_tracking:
+        mark_for_process_sample(pty_id)
+    return True
+
+def process_pool_command(cmd):
+    size = cmd.get("size", 0)
+    if size <= 0:
+        configure_pool(None)
+        return True
+
+    argv, env, cwd = session_spawn_args(cmd)
+    configure_pool(PoolProfile(argv, env, cwd, cmd.get("rows", 24), cmd.get("columns", 80), size,
+        cmd.get("ttl", POOL_DEFAULT_TTL)))
     return True
 
 def process_resize_command(cmd):
-    pty = find_pty_by_id(cmd["id"])
-    if pty is None:
+    session = pty_sessions.get(cmd["id"])
+    if session is None:
         log("Received a resize command for an unknown pty (id=" + str(cmd["id"]) + ")")
         return True
-    pty.setwinsize(cmd["rows"], cmd["columns"])
+    resize_session(session, cmd["rows"], cmd["columns"])
+    return True
+
+def process_resize_many_command(cmd):
+    for size in cmd["sizes"]:
+        session = pty_sessions.get(size["id"])
+        if session is None:
+            log("Received a resize-many command for an unknown pty (id=" + str(size["id"]) + ")")
+            continue
+        resize_session(session, size["rows"], size["columns"])
     return True
 
 def process_permit_data_size_command(cmd):
-    reader = find_reader_by_id(cmd["id"])
-    if reader is None:
+    session = pty_sessions.get(cmd["id"])
+    if session is None:
         log("Received a permit-data-size command for an unknown pty (id=" + str(cmd["id"]) + ")")
         return True
-    reader.permitDataSize(cmd["size"])
+    session.reader.permitDataSize(cmd["size"])
     return True
 
 def process_write_command(cmd):
     if LOG_FINE:
         log("process_write_command()")
-    pty_tuple = find_pty_tuple_by_id(cmd["id"])
-    if pty_tuple is None:
+    session = pty_sessions.get(cmd["id"])
+    if session is None:
         log("Received a write command for an unknown pty (id=" + str(cmd["id"]) + ")")
         return True
-    pty_tuple["writer"].write(cmd["data"])
+    session.last_input_time = time.monotonic()
+    session.writer.write(cmd["data"])
+    if process_tracking:
+        mark_for_process_sample(session.id)
     return True
 
 def process_close_command(cmd):
-    pty_tuple = find_pty_tuple_by_id(cmd["id"])
-    if pty_tuple is None:
+    session = pty_sessions.get(cmd["id"])
+    if session is None:
         log("Received a close command for an unknown pty (id=" + str(cmd["id"]) + ")")
         return True
 
-    pty_tuple["pty"].terminate(True)
+    terminate_pty_async(session)
     return True
 
+shutdown_deadline = None
+
 def process_terminate_command(cmd):
-    for pty_tup in pty_list:
-        pty_tup["pty"].terminate(True)
-        pty_tup["reader"].permitDataSize(1024*1024*1024)
-    return False
+    global shutdown_deadline
+    configure_pool(None)
+    for session in pty_sessions.values():
+        terminate_pty_async(session)
+        session.reader.permitDataSize(1024*1024*1024)
+
+    # Keep running until all of the ptys are closed, but not forever.
+    shutdown_delay = TERMINATE_STEP_DELAY * (len(TERMINATE_SIGNALS) + 1)
+    shutdown_deadline = time.monotonic() + shutdown_delay
+    call_later(shutdown_delay, lambda: None)
+    return True
+
+def process_get_working_directory_command(cmd):
+    session = pty_sessions.get(cmd["id"])
+    process = None if session is None else sample_session_process(session)
+    # Always reply, Extraterm is waiting for an answer.
+    send_to_controller({"type": "working-directory", "id": cmd["id"], "cwd": None if process is None else process[2]})
+    return True
+
+loop_wakeups = 0   # Times the main loop has woken up from waiting on I/O.
+stats_previous_time = time.monotonic()
+stats_previous_wakeups = 0
+
+def process_stats_command(cmd):
+    global stats_previous_time
+    global stats_previous_wakeups
+
+    now = time.monotonic()
+    wakeups_per_second = (loop_wakeups - stats_previous_wakeups) / max(now - stats_previous_time, 0.001)
+    stats_previous_time = now
+    stats_previous_wakeups = loop_wakeups
+
+    sessions = []
+    for session in pty_sessions.values():
+        reader = session.reader
+        writer = session.writer
+        sessions.append({
+            "id": session.id,
+            "bytesRead": reader.bytes_read,
+            "reads": reader.read_count,
+            "outputMessages": reader.output_count,
+            "creditBlockedTime": reader.creditBlockedTime(),
+            "bufferedBytes": 0 if reader.buffer is None else len(reader.buffer),
+            "spooledBytes": reader.spooledBytes(),
+            "spoolEvictedBytes": reader.spool_evicted_bytes,
+            "bytesWritten": writer.bytes_written,
+            "writes": writer.write_count,
+            "queuedWrites": len(writer.string_list),
+            "queuedWriteBytes": writer.queuedBytes(),
+        })
+    msg = {"type": "stats", "wakeups": loop_wakeups, "wakeupsPerSecond": wakeups_per_second, "sessions": sessions}
+    if worker_mode:
+        send_to_front(msg)     # The front merges the replies of all workers.
+    else:
+        send_to_controller(msg)
+    return True
+
+def process_configure_command(cmd):
+    global controller_framing
+    global controller_compression
+    global controller_out
+    global process_tracking
+
+    framing = cmd.get("framing", FRAMING_JSON)
+    if framing not in (FRAMING_JSON, FRAMING_BINARY):
+        log("Received a configure command with unknown framing '" + str(framing) + "'")
+        framing = FRAMING_JSON
+
+    compression = cmd.get("compression", COMPRESSION_NONE)
+    if compression not in (COMPRESSION_NONE, COMPRESSION_ZLIB):
+        log("Received a configure command with unknown compression '" + str(compression) + "'")
+        compression = COMPRESSION_NONE
+    if worker_mode or controller_compression == COMPRESSION_ZLIB:
+        compression = controller_compression     # The front does the compressing.
+
+    if not worker_mode:
+        send_to_controller({"type": "configured", "framing": framing, "compression": compression,
+            "resizeMany": True})
+    controller_framing = framing
+    process_tracking = bool(cmd.get("processTracking", False))
+    if process_tracking:
+        for pty_id in pty_sessions:
+            mark_for_process_sample(pty_id)
+    if compression != controller_compression:
+        controller_compression = compression
+        controller_out = ZlibWriter(controller_out)
+    return True
+
+command_handlers = {
+    "create": process_create_command,
+    "write": process_write_command,
+    "resize": process_resize_command,
+    "resize-many": process_resize_many_command,
+    "permit-data-size": process_permit_data_size_command,
+    "close": process_close_command,
+    "terminate": process_terminate_command,
+    "configure": process_configure_command,
+    "pool": process_pool_command,
+    "stats": process_stats_command,
+    "get-working-directory": process_get_working_directory_command,
+}
+
+def encode_message(msg):
+    # Non-ASCII text is sent as UTF-8. Escaping it would take 6 bytes for each
+    # CJK character and 12 for each emoji.
+    msg_text = json.dumps(msg, ensure_ascii=False)
+    try:
+        return msg_text, msg_text.encode("utf-8")
+    except UnicodeEncodeError:
+        # Lone surrogates, e.g. from undecodable file names, can only be sent escaped.
+        msg_text = json.dumps(msg)
+        return msg_text, msg_text.encode("utf-8")
 
 def send_to_controller(msg):
-    msg_text = json.dumps(msg)+"\n"
+    msg_text, payload = encode_message(msg)
     if LOG_FINE:
         log("server >>> main : "+msg_text)
-    sys.stdout.write(msg_text)
-    sys.stdout.flush()
+    if controller_framing == FRAMING_BINARY or worker_mode:
+        controller_out.write(frame_header.pack(FRAME_TYPE_MESSAGE, 0, len(payload)))
+        controller_out.write(payload)
+    else:
+        controller_out.write(payload + b"\n")
 
-def find_pty_tuple_by_id(pty_id):
-    for pty_tup in pty_list:
-        if pty_tup["id"] == pty_id:
-            return pty_tup
-    return None
+def send_output_to_controller(pty_id, data):
+    if controller_framing == FRAMING_BINARY:
+        if LOG_FINE:
+            log("server >>> main : output frame for " + str(pty_id) + ": " + repr(data))
+        payload = data.encode("utf-8")
+        controller_out.write(frame_header.pack(FRAME_TYPE_OUTPUT, pty_id, len(payload)))
+        controller_out.write(payload)
+    else:
+        send_to_controller( {"type": "output", "id": pty_id, "data": data} )
+
+def flush_controller():
+    """Flush the messages sent with send_to_controller(). This is done once per main loop pass."""
+    controller_out.flush()
+
+base_environment = None
 
-def find_pty_by_id(pty_id):
-    for pty_tup in pty_list:
-        if pty_tup["id"] == pty_id:
-            return pty_tup["pty"]
-    return None
+def get_base_environment():
+    """The server's own environment, copied from os.environ once. Don't modify it."""
+    global base_environment
+    if base_environment is None:
+        base_environment = dict(os.environ)
+    return base_environment
 
-def find_reader_by_id(pty_id):
-    for pty_tup in pty_list:
-        if pty_tup["id"] == pty_id:
-            return pty_tup["reader"]
-    return None
+# Maps Windows style PATH values to their converted form. The Extraterm side
+# sends the same PATH for nearly every session.
+cygwin_path_cache = {}
+CYGWIN_PATH_CACHE_MAX_SIZE = 64
 
 def cygwin_convert_path_variable(path_var):
-    return subprocess.check_output(["/usr/bin/cygpath", "-p", path_var])
+    converted = cygwin_path_cache.get(path_var)
+    if converted is None:
+        converted = subprocess.check_output(["/usr/bin/cygpath", "-p", path_var]).decode("utf-8").rstrip("\n")
+        if len(cygwin_path_cache) >= CYGWIN_PATH_CACHE_MAX_SIZE:
+            cygwin_path_cache.clear()
+        cygwin_path_cache[path_var] = converted
+    return converted
+
+###########################################################################
+# Sharded mode
+#
+# With --workers N the process started by Extraterm becomes a front which
+# only routes messages, and the ptys live in N worker processes. A worker is
+# this same script started with --worker. It runs the normal main loop with
+# the front in the place of Extraterm. Pty I/O, decoding and encoding are
+# spread over N cores while Extraterm sees the same protocol as before.
+#
+# The front assigns pty IDs, passing them in the assignedId field of create
+# commands, and gives each new pty to the worker with the fewest sessions.
+# Commands for a pty go to the worker which owns it. Workers
+# always send binary frames to the front, holding messages or output in the
+# framing which Extraterm asked for. The front passes them on without decoding
+# them. One more frame type is only used between workers and the front:
+#
+#   FRAME_TYPE_WORKER_MESSAGE: a JSON message for the front itself, one of
+#       { type: "ended"; id: number; }  // Sent after the pty's closed message.
+#       { type: "pool"; ready: number; }    // Sent when the number of ready pooled ptys changes.
+#       stats message                   // The front merges the replies of all workers.
+#
+# The pool size is divided between the workers. A create which matches the
+# pool profile goes to the least loaded worker which has a pty ready for it.
+# A resize-many command is split up by worker.
+
+FRAME_TYPE_WORKER_MESSAGE = 2
+WORKER_READ_SIZE = 256 * 1024
+
+worker_mode = False     # True in a worker process.
+
+def send_to_front(msg):
+    payload = json.dumps(msg).encode("utf-8")
+    controller_out.write(frame_header.pack(FRAME_TYPE_WORKER_MESSAGE, 0, len(payload)))
+    controller_out.write(payload)
+
+
+class ShardWorker:
+    """A worker process, as seen from the front."""
+
+    def __init__(self):
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--worker"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.session_ids = set()
+        self.pool_ready = 0     # Pooled ptys ready in the worker, as far as the front knows.
+        self.pending_stats = collections.deque()   # Stats collections waiting for this worker's reply.
+        self.eof = False
+        self.terminating = False
+
+        self._stdin_fd = self.process.stdin.fileno()
+        self._stdout_fd = self.process.stdout.fileno()
+        os.set_blocking(self._stdin_fd, False)
+        os.set_blocking(self._stdout_fd, False)
+        self._pending_commands = bytearray()
+        self._closing = False
+        self._frames = bytearray()
+        set_fd_callback(self._stdout_fd, selectors.EVENT_READ, self._onReadable)
+
+    def send(self, json_command):
+        if self._closing or self.eof:
+            return
+        self._pending_commands += json_command.encode("utf-8") + b"\n"
+        self._onWritable()
+
+    def closeInput(self):
+        """Close the worker's stdin once the commands sent so far are written. The worker then exits."""
+        self._closing = True
+        self._onWritable()
+
+    def _onWritable(self):
+        if len(self._pending_commands) != 0:
+            try:
+                written = os.write(self._stdin_fd, self._pending_commands)
+                del self._pending_commands[:written]
+            except BlockingIOError:
+                pass
+            except OSError as e:
+                log("Unable to write to a worker process. " + str(e))
+                self._pending_commands.clear()
+        if len(self._pending_commands) != 0:
+            set_fd_callback(self._stdin_fd, selectors.EVENT_WRITE, self._onWritable)
+            return
+        set_fd_callback(self._stdin_fd, selectors.EVENT_WRITE, None)
+        if self._closing and not self.process.stdin.closed:
+            self.process.stdin.close()
+
+    def _onReadable(self):
+        try:
+            data = os.read(self._stdout_fd, WORKER_READ_SIZE)
+        except BlockingIOError:
+            return
+        if len(data) == 0:
+            self._onEOF()
+            return
+        self._frames += data
+        self._forwardFrames()
+
+    def _forwardFrames(self):
+        frames = self._frames
+        view = memoryview(frames)
+        offset = 0
+        run_start = 0   # Start of a run of frames which can be passed on as they are.
+        while len(frames) - offset >= frame_header.size:
+            frame_type, pty_id, length = frame_header.unpack_from(frames, offset)
+            payload_start = offset + frame_header.size
+            end = payload_start + length
+            if end > len(frames):
+                break
+            if frame_type == FRAME_TYPE_WORKER_MESSAGE or controller_framing != FRAMING_BINARY:
+                controller_out.write(view[run_start:offset])
+                run_start = end
+                with view[payload_start:end] as payload:
+                    if frame_type == FRAME_TYPE_WORKER_MESSAGE:
+                        process_worker_message(self, json.loads(bytes(payload)))
+                    elif frame_type == FRAME_TYPE_OUTPUT:
+                        # Only when the framing has just been switched back to JSON.
+                        send_output_to_controller(pty_id, codecs.utf_8_decode(payload, "ignore")[0])
+                    else:
+                        controller_out.write(payload)
+                        controller_out.write(b"\n")
+            offset = end
+        controller_out.write(view[run_start:offset])
+        view.release()
+        del frames[:offset]
+
+    def _onEOF(self):
+        self.eof = True
+        set_fd_callback(self._stdout_fd, selectors.EVENT_READ, None)
+        set_fd_callback(self._stdin_fd, selectors.EVENT_WRITE, None)
+        if not self._closing and not self.terminating:
+            log("A worker process exited unexpectedly.")
+        # Don't leave Extraterm waiting for ptys which went with the worker.
+        for pty_id in sorted(self.session_ids):
+            del shard_sessions[pty_id]
+            send_to_controller({"type": "closed", "id": pty_id})
+        self.session_ids.clear()
+
+
+shard_workers = []
+shard_sessions = {}     # Maps pty ID to the ShardWorker which owns it.
+shard_pool_key = None   # pool_key() of the pool profile, or None.
+
+def command_pool_key(cmd):
+    """Work out the pool key of a create or pool command without changing the command."""
+    cmd = dict(cmd)
+    if cmd.get("env") is not None:
+        cmd["env"] = dict(cmd["env"])
+    return pool_key(*session_spawn_args(cmd))
+
+def choose_worker(cmd):
+    """Pick the worker for a create command, or None if every worker has gone."""
+    workers = [w for w in shard_workers if not w.eof]
+    if shard_pool_key is not None and command_pool_key(cmd) == shard_pool_key:
+        pooled_workers = [w for w in workers if w.pool_ready > 0]
+        if len(pooled_workers) != 0:
+            worker = min(pooled_workers, key=lambda w: len(w.session_ids))
+            worker.pool_ready -= 1     # Until the worker reports its pool again.
+            return worker
+    return min(workers, key=lambda w: len(w.session_ids), default=None)
+
+def route_command(json_command):
+    global pty_counter
+    global shard_pool_key
+
+    if LOG_FINE:
+        log("front process command:" + repr(json_command))
+    cmd = json.loads(json_command)
+    cmd_type = cmd["type"]
+
+    if cmd_type == "create":
+        pty_id = pty_counter
+        pty_counter += 1
+        worker = choose_worker(cmd)
+        if worker is None:
+            log("No worker process is left to create a pty.")
+            # Don't leave Extraterm waiting for the pty.
+            send_to_controller({"type": "created", "id": pty_id})
+            send_to_controller({"type": "closed", "id": pty_id})
+            return
+        cmd["assignedId"] = pty_id
+        shard_sessions[pty_id] = worker
+        worker.session_ids.add(pty_id)
+        worker.send(json.dumps(cmd))
+    elif cmd_type == "configure":
+        process_configure_command(cmd)
+        for worker in shard_workers:
+            worker.send(json_command)
+    elif cmd_type == "pool":
+        size = max(0, cmd.get("size", 0))
+        shard_pool_key = command_pool_key(cmd) if size > 0 else None
+        workers = [w for w in shard_workers if not w.eof]
+        for i, worker in enumerate(workers):
+            cmd["size"] = size // len(workers) + (1 if i < size % len(workers) else 0)
+            worker.send(json.dumps(cmd))
+    elif cmd_type == "resize-many":
+        worker_sizes = {}
+        for size in cmd["sizes"]:
+            worker = shard_sessions.get(size["id"])
+            if worker is None:
+                log("ptyserver front received a resize for an unknown pty (id=" + str(size["id"]) + ")")
+                continue
+            worker_sizes.setdefault(worker, []).append(size)
+        for worker, sizes in worker_sizes.items():
+            worker.send(json.dumps({"type": "resize-many", "sizes": sizes}))
+    elif cmd_type == "stats":
+        collection = {"type": "stats", "wakeups": loop_wakeups, "wakeupsPerSecond": 0, "sessions": [],
+            "remaining": 0}
+        for worker in shard_workers:
+            if not worker.eof:
+                collection["remaining"] += 1
+                worker.pending_stats.append(collection)
+                worker.send(json_command)
+        if collection["remaining"] == 0:
+            del collection["remaining"]
+            send_to_controller(collection)
+    elif cmd_type == "terminate":
+        for worker in shard_workers:
+            worker.terminating = True
+            worker.send(json_command)
+    elif cmd.get("id") in shard_sessions:
+        shard_sessions[cmd["id"]].send(json_command)
+    else:
+        log("ptyserver front received a message for an unknown pty:" + json_command)
+        if cmd_type == "get-working-directory":
+            # Extraterm waits for an answer.
+            send_to_controller({"type": "working-directory", "id": cmd.get("id"), "cwd": None})
+
+def process_worker_message(worker, msg):
+    msg_type = msg["type"]
+    if msg_type == "ended":
+        pty_id = msg["id"]
+        if pty_id in worker.session_ids:
+            worker.session_ids.discard(pty_id)
+            del shard_sessions[pty_id]
+    elif msg_type == "pool":
+        worker.pool_ready = msg["ready"]
+    elif msg_type == "stats":
+        collection = worker.pending_stats.popleft()
+        collection["wakeups"] += msg["wakeups"]
+        collection["wakeupsPerSecond"] += msg["wakeupsPerSecond"]
+        collection["sessions"].extend(msg["sessions"])
+        collection["remaining"] -= 1
+        if collection["remaining"] == 0:
+            del collection["remaining"]
+            send_to_controller(collection)
+
+def run_front(worker_count):
+    """Main loop of the front in sharded mode."""
+    global loop_wakeups
+
+    if LOG_FINE:
+        log("pty server front starting " + str(worker_count) + " workers")
+    for i in range(worker_count):
+        shard_workers.append(ShardWorker())
+    stdin_reader = NonblockingLineReader(sys.stdin.fileno())
+
+    input_open = True
+    while not all(worker.eof for worker in shard_workers):
+        WaitOnIOActivity()
+        loop_wakeups += 1
+
+        for chunk in stdin_reader.readLines():
+            route_command(chunk.strip())
+        if input_open and stdin_reader.isEOF():
+            input_open = False
+            for worker in shard_workers:
+                worker.closeInput()
+        flush_controller()
+
+    for worker in shard_workers:
+        worker.process.wait()
+    if LOG_FINE:
+        log("pty server front exiting.")
+    sys.exit(0)
 
 def main():
-    global pty_list
+    global loop_wakeups
     running = True
     
     if LOG_FINE:
         log("pty server process starting up")
-    stdin_reader = NonblockingLineReader(sys.stdin)
+    stdin_reader = NonblockingLineReader(sys.stdin.fileno())
+    init_child_exit_detection()
     
+    output_hold_deadline = None
+    poll_io = False
     while running:
-        if LOG_FINER:
-            log("pty server thread active count: " + str(threading.active_count()))
-        WaitOnIOActivity()
+        timeout = 0 if poll_io else next_timer_timeout()
+        if output_hold_deadline is not None:
+            hold_timeout = max(0, output_hold_deadline - time.monotonic())
+            timeout = hold_timeout if timeout is None else min(timeout, hold_timeout)
+        WaitOnIOActivity(timeout)
+        loop_wakeups += 1
+        run_due_timers()
+        output_hold_deadline = None
+        poll_io = False
         if LOG_FINER:
             log("Server awake")
             
@@ -443,50 +2082,49 @@ def main():
                     log("server <<< main : EOF")
                 running = False
             
-            chunk = stdin_reader.read()
-            while chunk is not None:    # Consume all of the commands now. They have high prio.
-                if LOG_FINE:
-                    log("server <<< main : " + repr(chunk))
-                running = running and process_command(chunk.strip())
+            # Consume all of the commands now. They have high prio.
+            chunks = stdin_reader.readLines()
+            if len(chunks) != 0:
+                running = process_commands(chunks) and running
                 if LOG_FINE:
                     log("running: " + str(running))
-                chunk = stdin_reader.read()
-            
+            flush_writers()
+
             # Check our ptys for output.
-            for pty_struct in pty_list:
-                pty_chunk = pty_struct["reader"].read()
-                if pty_chunk is not None:   # Read one chunk at a time. Don't let one busy PTY suck up all of the attention.
-                    done = False
-                    if LOG_FINE:
-                        log("server <<< pty : " + repr(pty_chunk))
-                    # Decode the chunk of bytes.
-                    data = pty_struct["readDecoder"].decode(pty_chunk)
-                    send_to_controller( {"type": "output", "id": pty_struct["id"], "data": data} )
-
-                # Send any output-written message
-                writer = pty_struct["writer"]
-                total_chars_written = 0
-                next_chars_written = writer.nextCharsWritten()
-                while next_chars_written is not None:
-                    total_chars_written += next_chars_written
-                    next_chars_written = writer.nextCharsWritten()
-
-                if total_chars_written != 0:
-                    send_to_controller( {"type": "output-written", "id": pty_struct["id"], "chars": total_chars_written} )
-
-            # Check for exited ptys
-            for pty_struct in pty_list[:]:
-                if LOG_FINER:
-                    log("checking live pty: "+str(pty_struct["pty"].isalive()))
-                if not pty_struct["pty"].isalive():
-                    pty_list = [ t for t in pty_list if t["id"] != pty_struct["id"] ]
-                    send_to_controller( {"type": "closed", "id": pty_struct["id"] } )
-                    done = False
+            sent, budget_spent, hold_deadline = schedule_output()
+            if hold_deadline is not None:
+                # Wait a moment for more output to coalesce with.
+                if output_hold_deadline is None or hold_deadline < output_hold_deadline:
+                    output_hold_deadline = hold_deadline
+            if budget_spent:
+                # Check for new input and echo before sending more bulk output.
+                poll_io = True
+            elif sent:
+                done = False
+
+            # Check the ptys which may have exited.
+            if len(exit_check_ids) != 0:
+                check_ids = exit_check_ids.copy()
+                exit_check_ids.clear()
+                for pty_id in check_ids:
+                    session = pty_sessions.get(pty_id)
+                    if session is None:
+                        continue
+                    if LOG_FINER:
+                        log("checking live pty: "+str(session.pty.isalive()))
+                    if not session.pty.isalive():
+                        del pty_sessions[pty_id]
+                        drain_pty_output(session)
+                        release_pty_session(session)
+                        send_to_controller( {"type": "closed", "id": pty_id } )
+                        if worker_mode:
+                            send_to_front({"type": "ended", "id": pty_id})
+                        done = False
+
+            if shutdown_deadline is not None and (len(pty_sessions) == 0 or time.monotonic() >= shutdown_deadline):
+                running = False
 
-        if LOG_FINER:
-            log("pty server active count: " + str(threading.active_count()))
-            for t in threading.enumerate():
-                log("Thread: " + t.name)
+        flush_controller()
 
     sys.stdin.buffer.raw.close()
     if LOG_FINE:
@@ -495,6 +2133,12 @@ def main():
 
 
 class DeadPty:
+    """Stand-in for a pty whose command could not be started.
+
+    It has no file descriptor, its reads and writes never block.
+    """
+    fd = None
+
     def __init__(self, cmd_argv):
         self.__sent_error = False
         self.__terminated = False
@@ -507,11 +2151,10 @@ class DeadPty:
         if not self.__sent_error:
             self.__sent_error = True
             return ("\r\n\r\nShell or command '" + self.__cmd_argv[0] + "' could not be found!\r\n").encode("utf8")
-        time.sleep(60)
-        return b""
+        return None
 
     def write(self, s):
-        pass
+        return len(s)
 
     def setwinsize(self, rows, columns):
         pass
@@ -522,4 +2165,14 @@ class DeadPty:
     def terminate(self, force=True):
         self.__terminated = True
 
-main()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="pty server for Extraterm's proxy session backends.")
+    parser.add_argument("--workers", type=int, default=0,
+        help="Run the ptys in this many worker processes. Useful with more than one CPU core.")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.workers > 1:
+        run_front(args.workers)
+    else:
+        worker_mode = args.worker
+        main()
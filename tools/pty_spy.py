@@ -5,35 +5,196 @@
 #
 # Tool like `ttyrec` except that it records the traffic from the terminal back to the application.
 #
+# With `-t` it records both directions with timestamps in a capture file
+# which can be replayed with `--replay`. A capture file is:
+#
+#   magic: b'PTYSPY\x00\x01'
+#   records, each made of a header followed by `length` bytes of data:
+#     direction: uint8, b'i' for input to the application, b'o' for its output.
+#     time: uint64, microseconds since the start of the recording.
+#     length: uint32
+#   index: (file offset: uint64, time: uint64) for every INDEX_INTERVAL bytes of records.
+#   trailer:
+#     index offset: uint64
+#     index entry count: uint32
+#     magic: b'PTYSPYIX'
+#
+# All integers are little endian. The index lets a replay start part way in.
+#
 
 import argparse
 import os
 import pty
+import struct
+import sys
+import time
+
+MAGIC = b'PTYSPY\x00\x01'
+TRAILER_MAGIC = b'PTYSPYIX'
+record_header = struct.Struct('<cQI')
+index_entry = struct.Struct('<QQ')
+trailer = struct.Struct('<QI8s')
+
+DIRECTION_INPUT = b'i'
+DIRECTION_OUTPUT = b'o'
+
+READ_SIZE = 64 * 1024
+WRITE_BUFFER_SIZE = 1024 * 1024
+INDEX_INTERVAL = 1024 * 1024
+
+
+class CaptureWriter:
+    """Writes timed records of both directions to a capture file."""
+
+    def __init__(self, capture_file):
+        self._file = capture_file
+        self._start_ns = time.monotonic_ns()
+        self._offset = len(MAGIC)
+        self._next_index_offset = self._offset
+        self._index = []
+        self._file.write(MAGIC)
+
+    def write(self, direction, data):
+        timestamp = (time.monotonic_ns() - self._start_ns) // 1000
+        if self._offset >= self._next_index_offset:
+            self._index.append((self._offset, timestamp))
+            self._next_index_offset = self._offset + INDEX_INTERVAL
+        self._file.write(record_header.pack(direction, timestamp, len(data)))
+        self._file.write(data)
+        self._offset += record_header.size + len(data)
+
+    def close(self):
+        for entry in self._index:
+            self._file.write(index_entry.pack(*entry))
+        self._file.write(trailer.pack(self._offset, len(self._index), TRAILER_MAGIC))
+        self._file.close()
+
+
+class CaptureReader:
+    """Reads the records of a capture file written by `CaptureWriter`."""
+
+    def __init__(self, capture_file):
+        self._file = capture_file
+        if self._file.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not a pty_spy capture file.')
+
+        # Load the index from the end of the file.
+        self._file.seek(-trailer.size, os.SEEK_END)
+        self._index_offset, index_count, magic = trailer.unpack(self._file.read(trailer.size))
+        if magic != TRAILER_MAGIC:
+            raise ValueError('The capture file is incomplete.')
+        self._file.seek(self._index_offset)
+        index_data = self._file.read(index_count * index_entry.size)
+        self.index = [index_entry.unpack_from(index_data, i * index_entry.size) for i in range(index_count)]
+        self._file.seek(len(MAGIC))
+
+    def seek(self, timestamp):
+        """Move to the last indexed record at or before `timestamp` microseconds."""
+        offset = len(MAGIC)
+        for entry_offset, entry_time in self.index:
+            if entry_time > timestamp:
+                break
+            offset = entry_offset
+        self._file.seek(offset)
+
+    def records(self):
+        """Yield (direction, timestamp, data) for each record from the current position."""
+        while self._file.tell() < self._index_offset:
+            direction, timestamp, length = record_header.unpack(self._file.read(record_header.size))
+            yield direction, timestamp, self._file.read(length)
 
-parser = argparse.ArgumentParser(description='Capture input to a terminal application and write it to a file.')
-parser.add_argument('-a', dest='append', action='store_true', help='Append to the output file.')
-parser.add_argument('-e', dest='command', help='Command to run. Defaults to a shell.')
-parser.add_argument('filename', nargs='?', default='pty_spy_output.txt', help='File to write the captured data to.')
-options = parser.parse_args()
-
-mode = 'ab' if options.append else 'wb'
-if options.command is not None:
-    shell = ['/bin/sh','-c', options.command]
-else:
-    shell = os.environ.get('SHELL', 'sh')
-filename = options.filename
-
-with open(filename, mode) as stdin_script:
-    def read(fd):
-        data = os.read(fd, 1024)
-        return data
-
-    def stdin_read(fd):
-        data = os.read(fd, 1024)
-        stdin_script.write(data)
-        return data
-
-    print('Running ', shell, ' and capturing data to file ', filename)
-    pty.spawn(shell, read, stdin_read)
+
+def is_capture_file(filename):
+    with open(filename, 'rb') as capture_file:
+        return capture_file.read(len(MAGIC)) == MAGIC
+
+
+def record_input(shell, filename, append):
+    mode = 'ab' if append else 'wb'
+    with open(filename, mode) as stdin_script:
+        def read(fd):
+            data = os.read(fd, 1024)
+            return data
+
+        def stdin_read(fd):
+            data = os.read(fd, 1024)
+            stdin_script.write(data)
+            return data
+
+        print('Running ', shell, ' and capturing data to file ', filename)
+        pty.spawn(shell, read, stdin_read)
+
+
+def record_timed(shell, filename):
+    writer = CaptureWriter(open(filename, 'wb', buffering=WRITE_BUFFER_SIZE))
+    try:
+        def read(fd):
+            data = os.read(fd, READ_SIZE)
+            writer.write(DIRECTION_OUTPUT, data)
+            return data
+
+        def stdin_read(fd):
+            data = os.read(fd, READ_SIZE)
+            writer.write(DIRECTION_INPUT, data)
+            return data
+
+        print('Running ', shell, ' and recording both directions to file ', filename)
+        pty.spawn(shell, read, stdin_read)
+    finally:
+        writer.close()
+
+
+def replay(filename, direction, fast, start):
+    """Write one direction of a capture to stdout, at recorded speed or as fast as possible."""
+    out = sys.stdout.buffer
+    with open(filename, 'rb', buffering=READ_SIZE) as capture_file:
+        reader = CaptureReader(capture_file)
+        start_us = int(start * 1000000)
+        reader.seek(start_us)
+        replay_start = time.monotonic()
+        for record_direction, timestamp, data in reader.records():
+            if record_direction != direction or timestamp < start_us:
+                continue
+            if not fast:
+                delay = (timestamp - start_us) / 1000000 - (time.monotonic() - replay_start)
+                if delay > 0:
+                    out.flush()
+                    time.sleep(delay)
+            out.write(data)
+    out.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Capture the traffic of a terminal application to a file, or replay a capture.')
+    parser.add_argument('-a', dest='append', action='store_true', help='Append to the output file.')
+    parser.add_argument('-e', dest='command', help='Command to run. Defaults to a shell.')
+    parser.add_argument('-t', dest='timed', action='store_true',
+                        help='Record both directions with timestamps in a capture file.')
+    parser.add_argument('--replay', action='store_true', help='Replay a capture file made with -t to stdout.')
+    parser.add_argument('--input', action='store_true', help='Replay the input side instead of the output.')
+    parser.add_argument('--fast', action='store_true', help='Replay as fast as possible instead of at recorded speed.')
+    parser.add_argument('--start', type=float, default=0.0, help='Seconds into the capture to start replaying from.')
+    parser.add_argument('filename', nargs='?', default='pty_spy_output.txt', help='File to write the captured data to.')
+    options = parser.parse_args()
+
+    filename = options.filename
+    if options.replay:
+        replay(filename, DIRECTION_INPUT if options.input else DIRECTION_OUTPUT, options.fast, options.start)
+        return
+
+    if options.command is not None:
+        shell = ['/bin/sh','-c', options.command]
+    else:
+        shell = os.environ.get('SHELL', 'sh')
+
+    if options.timed:
+        if options.append:
+            parser.error('-a can not be used with -t')
+        record_timed(shell, filename)
+    else:
+        record_input(shell, filename, options.append)
     print('')
     print('Done. Data captured to file ', filename)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1109 @@
+#!env python3
+#
+# ptyserver_bench.py
+# Simon Edwards <simon@simonzone.com>
+#
+# Benchmarks for the proxy pty server `ptyserver2.py` used by the Cygwin
+# session backend. The server is started as a subprocess and driven over its
+# stdin/stdout like the Extraterm side does.
+#
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import select
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import pty_spy
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '..', 'extensions', 'ProxySessionBackend', 'src', 'python', 'ptyserver2.py')
+PTY_SPY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pty_spy.py')
+
+FRAME_TYPE_MESSAGE = 0
+FRAME_TYPE_OUTPUT = 1
+frame_header = struct.Struct('>BII')
+
+
+class PtyServerClient:
+    """Minimal stand in for the `ProxyPtyConnector` side of the protocol."""
+
+    server_path = SERVER_PATH
+    server_args = []
+
+    def __init__(self, server_args=(), framing='json', compression='none', process_tracking=False):
+        self.process = subprocess.Popen([sys.executable, self.server_path] + self.server_args + list(server_args),
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._stdout_fd = self.process.stdout.fileno()
+        self._buffer = b''
+        self._decompressor = None
+        self._unconsumed = []   # Messages which create() received but didn't use.
+        self.bytes_received = 0
+        self.framing = 'json'
+        self.configured = False
+        if framing != 'json' or compression != 'none' or process_tracking:
+            self.send({'type': 'configure', 'framing': framing, 'compression': compression,
+                       'processTracking': process_tracking})
+            while not self.configured:
+                self.receive(5.0)
+
+    def send(self, msg):
+        self.process.stdin.write((json.dumps(msg) + '\n').encode('utf-8'))
+        self.process.stdin.flush()
+
+    def receive(self, timeout):
+        """Wait up to `timeout` seconds for messages and return the ones which arrived."""
+        if len(self._unconsumed) != 0:
+            messages = self._unconsumed
+            self._unconsumed = []
+            return messages
+        return self._readMessages(timeout)
+
+    def _readMessages(self, timeout):
+        readable, _, _ = select.select([self._stdout_fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self._stdout_fd, 1024 * 1024)
+        if data == b'':
+            raise EOFError('The server closed its stdout.')
+        self.bytes_received += len(data)
+        if self._decompressor is not None:
+            data = self._decompressor.decompress(data)
+        self._buffer += data
+        messages = []
+        offset = 0
+        while True:
+            if self.framing == 'json':
+                end = self._buffer.find(b'\n', offset)
+                if end == -1:
+                    break
+                msg = json.loads(self._buffer[offset:end])
+                offset = end + 1
+                if msg['type'] == 'configured':
+                    self._configured(msg, offset)
+                    continue
+            else:
+                if len(self._buffer) - offset < frame_header.size:
+                    break
+                frame_type, pty_id, length = frame_header.unpack_from(self._buffer, offset)
+                end = offset + frame_header.size + length
+                if end > len(self._buffer):
+                    break
+                payload = self._buffer[offset + frame_header.size:end]
+                offset = end
+                if frame_type == FRAME_TYPE_OUTPUT:
+                    msg = {'type': 'output', 'id': pty_id, 'data': payload.decode('utf-8')}
+                else:
+                    msg = json.loads(payload)
+                    if msg['type'] == 'configured':
+                        self._configured(msg, offset)
+                        continue
+            messages.append(msg)
+        self._buffer = self._buffer[offset:]
+        return messages
+
+    def _configured(self, msg, offset):
+        """Switch to the configured framing and compression for everything after `offset`."""
+        self.configured = True
+        self.framing = msg['framing']
+        if msg.get('compression', 'none') == 'zlib' and self._decompressor is None:
+            self._decompressor = zlib.decompressobj()
+            self._buffer = self._buffer[:offset] + self._decompressor.decompress(self._buffer[offset:])
+
+    def create(self, argv, rows=24, columns=80, cwd=None, permit=1024 * 1024 * 1024, spool_size=0):
+        msg = {'type': 'create', 'argv': argv, 'rows': rows, 'columns': columns, 'cwd': cwd}
+        if spool_size != 0:
+            msg['spoolSize'] = spool_size
+        self.send(msg)
+        while True:
+            messages = self._readMessages(5.0)
+            for i, msg in enumerate(messages):
+                if msg['type'] == 'created':
+                    self.send({'type': 'permit-data-size', 'id': msg['id'], 'size': permit})
+                    # Keep the other messages, e.g. output of earlier sessions, for receive().
+                    self._unconsumed.extend(messages[:i] + messages[i+1:])
+                    return msg['id']
+            self._unconsumed.extend(messages)
+
+    def terminate(self):
+        self.send({'type': 'terminate'})
+        self.process.stdin.close()
+        # The server keeps sending output while it shuts down.
+        while os.read(self._stdout_fd, 1024 * 1024) != b'':
+            pass
+        self.process.wait(10)
+
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def format_latencies(name, latencies):
+    return '%-10s n=%4d  p50=%7.2fms  p99=%7.2fms  max=%7.2fms' % (name, len(latencies),
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+        max(latencies) * 1000 if latencies else float('nan'))
+
+
+class EchoProber:
+    """Measures keystroke round trip latency through `cat` sessions.
+
+    The tty echoes each probe character straight back, so this is the time
+    the server needs to pass on a write and the resulting output.
+    """
+
+    PROBE_CHARS = 'abcdefghijklmnopqrstuvwxyz'
+
+    def __init__(self, client, pty_ids):
+        self.client = client
+        self._outstanding = {}  # pty id -> (probe char, send time)
+        self._next_char = 0
+        self.pty_ids = pty_ids
+
+    def send_probes(self):
+        for pty_id in self.pty_ids:
+            if pty_id not in self._outstanding:
+                char = self.PROBE_CHARS[self._next_char % len(self.PROBE_CHARS)]
+                self._next_char += 1
+                self._outstanding[pty_id] = (char, time.perf_counter())
+                self.client.send({'type': 'write', 'id': pty_id, 'data': char})
+
+    def handle_message(self, msg):
+        """Returns the round trip latency if `msg` completes a probe."""
+        if msg['type'] != 'output' or msg['id'] not in self._outstanding:
+            return None
+        char, start = self._outstanding[msg['id']]
+        if char not in msg['data']:
+            return None
+        del self._outstanding[msg['id']]
+        return time.perf_counter() - start
+
+
+def bench_close_latency(options):
+    """Echo latency of idle sessions while other sessions are being closed.
+
+    The sessions being closed ignore SIGHUP and SIGINT, so the server has to
+    escalate all the way to SIGKILL for each of them.
+    """
+    client = PtyServerClient()
+    echo_ids = [client.create(['/bin/cat']) for i in range(options.sessions)]
+    stubborn_argv = ['/bin/sh', '-c', "trap '' HUP INT; while :; do sleep 1; done"]
+    stubborn_ids = [client.create(stubborn_argv) for i in range(options.stubborn)]
+
+    prober = EchoProber(client, echo_ids)
+    baseline = []
+    closing = []
+    closed_ids = set()
+    close_start = None
+    close_duration = None
+
+    start = time.perf_counter()
+    while True:
+        now = time.perf_counter()
+        if close_start is None and now - start >= options.warmup:
+            close_start = now
+            for pty_id in stubborn_ids:
+                client.send({'type': 'close', 'id': pty_id})
+        if close_start is not None and close_duration is not None and now - close_start > close_duration + 0.2:
+            break
+        if now - start > options.warmup + 10:
+            print('Timed out waiting for the stubborn sessions to close.')
+            break
+
+        prober.send_probes()
+        for msg in client.receive(0.01):
+            if msg['type'] == 'closed':
+                closed_ids.add(msg['id'])
+                if closed_ids.issuperset(stubborn_ids):
+                    close_duration = time.perf_counter() - close_start
+            latency = prober.handle_message(msg)
+            if latency is not None:
+                (baseline if close_start is None else closing).append(latency)
+
+    client.terminate()
+
+    print('Echo round trip over %d cat sessions while closing %d stubborn sessions' %
+          (options.sessions, options.stubborn))
+    print(format_latencies('baseline', baseline))
+    print(format_latencies('closing', closing))
+    if close_duration is not None:
+        print('All stubborn sessions closed after %.0fms' % (close_duration * 1000))
+
+
+def bench_compression(options):
+    """Bytes on the wire and server CPU with and without zlib compression.
+
+    Each corpus of typical terminal output is cat'ed through a few sessions
+    with plain JSON lines, binary frames and compressed binary frames.
+    """
+    modes = [('json', 'none'), ('binary', 'none'), ('json', 'zlib'), ('binary', 'zlib')]
+    with tempfile.TemporaryDirectory() as directory:
+        corpora = write_replay_corpora(directory, options.megabytes)
+        names = sorted(corpora.keys()) if options.corpus is None else [options.corpus]
+        print('%d sessions each cat %dMB of a corpus' % (options.sessions, options.megabytes))
+        for name in names:
+            json_wire_bytes = None
+            for framing, compression in modes:
+                client = PtyServerClient(framing=framing, compression=compression)
+                start_cpu = server_cpu_seconds(client)
+                start = time.perf_counter()
+                start_bytes = client.bytes_received
+                open_ids = set(client.create(['/bin/cat', corpora[name]]) for i in range(options.sessions))
+                output_bytes = 0
+                while len(open_ids) != 0:
+                    for msg in client.receive(1.0):
+                        if msg['type'] == 'output':
+                            output_bytes += len(msg['data'].encode('utf-8'))
+                        elif msg['type'] == 'closed':
+                            open_ids.discard(msg['id'])
+                elapsed = time.perf_counter() - start
+                server_cpu = server_cpu_seconds(client) - start_cpu
+                wire_bytes = client.bytes_received - start_bytes
+                client.terminate()
+                if json_wire_bytes is None:
+                    json_wire_bytes = wire_bytes
+                megabytes = output_bytes / 1024 / 1024
+                print('%-9s %-6s %-4s %7.1f MB on the wire (%5.1f%% of JSON lines), %6.1f MB/s, '
+                      '%.3fs server CPU per MB' % (name, framing, compression, wire_bytes / 1024 / 1024,
+                      wire_bytes * 100 / json_wire_bytes, megabytes / elapsed, server_cpu / max(megabytes, 0.001)))
+
+
+def bench_interactive(options):
+    """Echo latency of one interactive session while other sessions flood output.
+
+    The flooding sessions are created first, so without any prioritisation the
+    interactive session is served after them. The share of output each
+    flooding session got shows how fairly they are treated.
+    """
+    client = PtyServerClient(framing=options.framing)
+    flood_line = 'flood ' + 'x' * 120
+    flood_ids = [client.create(['yes', flood_line]) for i in range(options.sessions)]
+    probe_ids = [client.create(['/bin/cat'])]
+    prober = EchoProber(client, probe_ids)
+
+    flood_bytes = {pty_id: 0 for pty_id in flood_ids}
+    latencies = []
+    start = time.perf_counter()
+    start_cpu = server_cpu_seconds(client)
+    next_probe = start + options.warmup
+    while True:
+        now = time.perf_counter()
+        if now - start >= options.warmup + options.duration:
+            break
+        if now >= next_probe:
+            prober.send_probes()
+            next_probe = now + 0.01
+        for msg in client.receive(0.01):
+            latency = prober.handle_message(msg)
+            if latency is not None:
+                if now - start >= options.warmup:
+                    latencies.append(latency)
+            elif msg['type'] == 'output' and msg['id'] in flood_bytes:
+                if now - start >= options.warmup:
+                    flood_bytes[msg['id']] += len(msg['data'])
+    server_cpu = server_cpu_seconds(client) - start_cpu
+    client.terminate()
+
+    shares = sorted(flood_bytes.values())
+    print('Echo round trip of one cat session while %d sessions flood output' % options.sessions)
+    print(format_latencies('keystroke', latencies))
+    print('%6.1f MB/s flood output, per session min/max %.2f, %4.2fs server CPU' % (
+          sum(shares) / options.duration / 1024 / 1024, shares[0] / max(1, shares[-1]), server_cpu))
+
+
+def bench_process_tracking(options):
+    """How quickly process-changed messages follow a cd, and what tracking costs under load.
+
+    A shell alternates between two directories, pausing before each cd, and
+    the time until the server pushes the new working directory is measured. Then sessions flood output
+    with tracking off and on to compare server CPU.
+    """
+    client = PtyServerClient(framing=options.framing, process_tracking=True)
+    shell_id = client.create(['/bin/sh'])
+    directories = ['/tmp', '/']
+    latencies = []
+    for i in range(20):
+        directory = directories[i % 2]
+        time.sleep(0.5)     # Typing the next command takes a while.
+        client.receive(0)
+        start = time.perf_counter()
+        client.send({'type': 'write', 'id': shell_id, 'data': 'cd %s\n' % directory})
+        deadline = start + 5.0
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                print('FAIL: No process-changed message for a cd to %s.' % directory)
+                sys.exit(1)
+            messages = client.receive(remaining)
+            if any(msg['type'] == 'process-changed' and msg['cwd'] == directory for msg in messages):
+                break
+        latencies.append(time.perf_counter() - start)
+    client.terminate()
+    print(format_latencies('cd to process-changed', latencies))
+
+    flood_line = 'flood ' + 'x' * 120
+    for process_tracking in (False, True):
+        client = PtyServerClient(framing=options.framing, process_tracking=process_tracking)
+        for i in range(options.sessions):
+            client.create(['yes', flood_line])
+        received = 0
+        changes = 0
+        start = time.perf_counter()
+        start_cpu = server_cpu_seconds(client)
+        while time.perf_counter() - start < options.duration:
+            for msg in client.receive(0.01):
+                if msg['type'] == 'output':
+                    received += len(msg['data'])
+                elif msg['type'] == 'process-changed':
+                    changes += 1
+        server_cpu = server_cpu_seconds(client) - start_cpu
+        client.terminate()
+        megabytes = received / 1024 / 1024
+        print('tracking %-3s %d sessions flooding: %6.1f MB/s, %.4fs server CPU per MB, %d process-changed messages' % (
+              'on' if process_tracking else 'off', options.sessions, megabytes / options.duration,
+              server_cpu / max(megabytes, 0.001), changes))
+
+
+REDRAW_PROGRAM = r"""
+import os, signal, sys, time
+def redraw(*args):
+    columns, rows = os.get_terminal_size(0)
+    sys.stdout.write('\x1b[H\x1b[2J' + ('#' * columns + '\r\n') * (rows - 1) + 'REDRAW %d %d\r\n' % (rows, columns))
+    sys.stdout.flush()
+signal.signal(signal.SIGWINCH, redraw)
+sys.stdin.readline()
+print('READY', flush=True)
+while True:
+    time.sleep(60)
+"""
+
+def bench_resize(options):
+    """Redraws caused by dragging a window edge across sessions running a full screen program.
+
+    Each session redraws its whole screen on SIGWINCH. The drag resizes every
+    session 60 times in one second, as single resize messages and as one
+    resize-many message per step.
+    """
+    steps = 60
+    for batched in (False, True):
+        client = PtyServerClient(framing=options.framing)
+        pty_ids = [client.create([sys.executable, '-c', REDRAW_PROGRAM]) for i in range(options.sessions)]
+        for pty_id in pty_ids:
+            client.send({'type': 'write', 'id': pty_id, 'data': '\n'})
+        ready = set()
+        while len(ready) < len(pty_ids):
+            for msg in client.receive(5.0):
+                if msg['type'] == 'output' and 'READY' in msg['data']:
+                    ready.add(msg['id'])
+
+        output_bytes = 0
+        last_redraw = {}
+        buffers = {pty_id: '' for pty_id in pty_ids}
+        def handle(messages):
+            nonlocal output_bytes
+            for msg in messages:
+                if msg['type'] != 'output':
+                    continue
+                output_bytes += len(msg['data'])
+                text = buffers[msg['id']] + msg['data']
+                for line in text.split('\r\n')[:-1]:
+                    if line.startswith('REDRAW '):
+                        last_redraw.setdefault(msg['id'], []).append(tuple(int(x) for x in line.split()[1:]))
+                buffers[msg['id']] = text[text.rfind('\r\n') + 2:] if '\r\n' in text else text
+
+        start = time.perf_counter()
+        for step in range(steps):
+            columns = 80 + step + 1
+            if batched:
+                client.send({'type': 'resize-many', 'sizes': [{'id': pty_id, 'rows': 24, 'columns': columns}
+                                                             for pty_id in pty_ids]})
+            else:
+                for pty_id in pty_ids:
+                    client.send({'type': 'resize', 'id': pty_id, 'rows': 24, 'columns': columns})
+            handle(client.receive(max(0, start + (step + 1) / steps - time.perf_counter())))
+        settle_end = time.perf_counter() + 1.0
+        while time.perf_counter() < settle_end:
+            handle(client.receive(0.05))
+        client.terminate()
+
+        redraws = sum(len(sizes) for sizes in last_redraw.values())
+        final_ok = all(last_redraw.get(pty_id, [None])[-1] == (24, 80 + steps) for pty_id in pty_ids)
+        print('%-11s %d sessions: %5d resize messages, %5d redraws, %6.2f MB of output, final size %s' % (
+              'resize-many' if batched else 'resize', len(pty_ids), steps * (1 if batched else len(pty_ids)),
+              redraws, output_bytes / 1024 / 1024, 'correct' if final_ok else 'WRONG'))
+        if not final_ok:
+            sys.exit(1)
+
+
+def bench_lone_surrogate(options):
+    """Check that a write holding a lone surrogate doesn't take down the server.
+
+    Extraterm sends one when a surrogate pair is split between two writes.
+    Both sessions must still echo afterwards and the write must be counted
+    in output-written like any other.
+    """
+    client = PtyServerClient(framing=options.framing)
+    pty_ids = [client.create(['sh', '-c', 'stty raw -echo; exec cat']) for i in range(2)]
+    time.sleep(0.2)     # Let stty run.
+    client.send({'type': 'write', 'id': pty_ids[0], 'data': 'a\ud83d'})
+    for pty_id in pty_ids:
+        client.send({'type': 'write', 'id': pty_id, 'data': 'ping%d' % pty_id})
+
+    echoes = {pty_id: '' for pty_id in pty_ids}
+    chars_written = {pty_id: 0 for pty_id in pty_ids}
+    deadline = time.perf_counter() + 5.0
+    while time.perf_counter() < deadline:
+        if all('ping%d' % pty_id in echoes[pty_id] for pty_id in pty_ids):
+            break
+        try:
+            messages = client.receive(deadline - time.perf_counter())
+        except EOFError:
+            print('FAIL: The server exited after a write with a lone surrogate.')
+            sys.exit(1)
+        for msg in messages:
+            if msg['type'] == 'output':
+                echoes[msg['id']] += msg['data']
+            elif msg['type'] == 'output-written':
+                chars_written[msg['id']] += msg['chars']
+            elif msg['type'] == 'closed':
+                print('FAIL: Session %d closed after a write with a lone surrogate.' % msg['id'])
+                sys.exit(1)
+    client.terminate()
+
+    for pty_id in pty_ids:
+        if 'ping%d' % pty_id not in echoes[pty_id]:
+            print('FAIL: Session %d stopped echoing after a write with a lone surrogate.' % pty_id)
+            sys.exit(1)
+    print('Lone surrogate write: echoes %r, output-written chars %r' % (echoes, chars_written))
+    print('OK')
+
+
+def make_output_generator(megabytes):
+    """Python code for a command which prints colored compiler log like lines."""
+    line = '\x1b[1m%06d\x1b[0m: \x1b[32mcompiling\x1b[0m src/module/file.c \x1b[33mwarning:\x1b[0m \u2018x\u2019 unused'
+    return ('import sys\nline = %r\nfor i in range(%d): sys.stdout.write(line %% i + "\\n")\n' %
+            (line, megabytes * 1024 * 1024 // len((line % 0).encode('utf-8'))))
+
+
+def run_bulk_output(options, framing):
+    client = PtyServerClient(framing=framing)
+    generator = make_output_generator(options.megabytes)
+    pty_ids = [client.create([sys.executable, '-c', generator]) for i in range(options.sessions)]
+
+    start = time.perf_counter()
+    start_cpu = time.process_time()
+    output_chars = 0
+    output_messages = 0
+    open_ids = set(pty_ids)
+    while len(open_ids) != 0:
+        for msg in client.receive(1.0):
+            if msg['type'] == 'output':
+                output_chars += len(msg['data'])
+                output_messages += 1
+            elif msg['type'] == 'closed':
+                open_ids.discard(msg['id'])
+    elapsed = time.perf_counter() - start
+    client_cpu = time.process_time() - start_cpu
+    client.terminate()
+
+    print('%-6s framing: %5.1f MB/s output, %6.0f output messages/s, %6.0f chars per message, '
+          '%5.1f MB on the wire, %4.2fs client CPU' % (framing,
+          output_chars / elapsed / 1024 / 1024, output_messages / elapsed,
+          output_chars / max(1, output_messages), client.bytes_received / 1024 / 1024, client_cpu))
+
+
+def bench_bulk_output(options):
+    """Throughput and message count while sessions produce a lot of output."""
+    print('Bulk output from %d sessions, %dMB each' % (options.sessions, options.megabytes))
+    run_bulk_output(options, options.framing)
+
+
+def bench_framing(options):
+    """Compare bulk output throughput of JSON line and binary framing."""
+    print('Bulk output from %d sessions, %dMB each' % (options.sessions, options.megabytes))
+    for framing in ('json', 'binary'):
+        run_bulk_output(options, framing)
+
+
+ENCODING_CORPORA = {
+    'ascii-log': '\x1b[32mINFO\x1b[0m 2021-03-04 12:00:01 worker-3 request /api/items?page=2 took 14ms\n',
+    'latin': 'Gr\u00fc\u00dfe aus K\u00f6ln, \u00e7a va tr\u00e8s bien, se\u00f1or! \u00bfQu\u00e9 tal?\n',
+    'cjk': '\u65e5\u672c\u8a9e\u306e\u30c6\u30ad\u30b9\u30c8\u3068\u4e2d\u6587\u6587\u672c\uff0c\ud55c\uad6d\uc5b4 \ud14d\uc2a4\ud2b8\u3002\n',
+    'emoji': 'build \U0001f680 tests \u2705 lint \u26a0\ufe0f deploy \U0001f389\U0001f525\U0001f60a\n',
+    'curses': '\x1b[7;1H\u2502\x1b[44m\u2588\u2588\u2591\u2591\x1b[0m \u2500\u2500\u252c\u2500\u2500 42% \u2502\x1b[K\r\n',
+}
+
+
+def bench_encoding(options):
+    """Bytes on the channel per output character for different kinds of text.
+
+    The reference is the UTF-8 size of the text itself, which is what binary
+    framing sends.
+    """
+    print('%-10s %10s %14s %14s' % ('corpus', 'UTF-8 B/ch', 'json B/ch', 'binary B/ch'))
+    for name, line in ENCODING_CORPORA.items():
+        repeat = options.megabytes * 1024 * 1024 // len(line.encode('utf-8'))
+        generator = 'import sys\nline = %r\nfor i in range(%d): sys.stdout.write(line)\n' % (line, repeat)
+        results = []
+        for framing in ['json', 'binary']:
+            client = PtyServerClient(framing=framing)
+            client.create(['sh', '-c', 'stty raw -echo; exec "$0" -c "$1"', sys.executable, generator])
+            start_bytes = client.bytes_received
+            output_chars = 0
+            open_session = True
+            while open_session:
+                for msg in client.receive(1.0):
+                    if msg['type'] == 'output':
+                        output_chars += len(msg['data'])
+                    elif msg['type'] == 'closed':
+                        open_session = False
+            client.terminate()
+            results.append((client.bytes_received - start_bytes) / max(1, output_chars))
+        print('%-10s %10.2f %14.2f %14.2f' % (name, len(line.encode('utf-8')) / len(line), results[0], results[1]))
+
+
+def repeat_to_size(data, size):
+    return (data * (size // max(1, len(data)) + 1))[:size]
+
+
+def write_replay_corpora(directory, megabytes):
+    """Write synthetic recordings of typical terminal output to files in `directory`.
+
+    Returns a dict mapping the corpus name to its file.
+    """
+    size = megabytes * 1024 * 1024
+    corpora = {}
+
+    # A large `cat` of source code.
+    source_dir = os.path.dirname(os.__file__)
+    sources = []
+    for name in sorted(os.listdir(source_dir))[:200]:
+        if name.endswith('.py'):
+            with open(os.path.join(source_dir, name), 'rb') as source_file:
+                sources.append(source_file.read())
+    corpora['cat'] = b''.join(sources)
+
+    # `find /`, many short lines.
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(sys.prefix):
+        paths.extend(os.path.join(dirpath, name) for name in dirnames + filenames)
+        if len(paths) > 20000:
+            break
+    corpora['find'] = ('\n'.join(paths) + '\n').encode('utf-8')
+
+    # A curses application redrawing a full screen with cursor movement and colors.
+    frames = []
+    for frame in range(200):
+        rows = ['\x1b[H\x1b[44;37m \u2554' + '\u2550' * 76 + '\u2557 \x1b[0m']
+        for row in range(22):
+            value = (frame * 7 + row * 13) % 100
+            rows.append('\x1b[%d;1H\x1b[44;37m \u2551\x1b[0m %-20s \x1b[32m%s\x1b[0m%s %3d%% \x1b[44;37m\u2551 \x1b[0m' %
+                        (row + 2, 'process-%d' % row, '\u2588' * (value // 2), ' ' * (50 - value // 2), value))
+        rows.append('\x1b[24;1H\x1b[7m F1 Help  F2 Setup  F10 Quit \x1b[0m\x1b[K')
+        frames.append(''.join(rows))
+    corpora['curses'] = ''.join(frames).encode('utf-8')
+
+    # Colored compiler logs.
+    line = '\x1b[1m%06d\x1b[0m: \x1b[32mcompiling\x1b[0m src/module/file.c \x1b[33mwarning:\x1b[0m \u2018x\u2019 unused\n'
+    corpora['compiler'] = ''.join(line % i for i in range(20000)).encode('utf-8')
+
+    paths = {}
+    for name, data in corpora.items():
+        paths[name] = os.path.join(directory, name + '.bin')
+        with open(paths[name], 'wb') as corpus_file:
+            corpus_file.write(repeat_to_size(data, size))
+    return paths
+
+
+def replay_command(path, options):
+    """Command which writes a recording into its pty."""
+    if pty_spy.is_capture_file(path):
+        command = [sys.executable, PTY_SPY_PATH, '--replay', path]
+        if not options.recorded_speed:
+            command.insert(3, '--fast')
+        return command
+    return ['/bin/cat', path]
+
+
+def bench_replay(options):
+    """Replay recorded output streams across many sessions at once.
+
+    Each session cats one recording into its pty, cycling through the
+    recordings. Meanwhile the keystroke round trip is probed through an idle
+    `cat` session. Recordings are raw output captures or `pty_spy.py -t`
+    captures given with --recording, or synthetic ones of `cat`, `find`, a
+    curses redraw and colored compiler logs.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        if options.recording:
+            recordings = {os.path.basename(path): path for path in options.recording}
+        else:
+            recordings = write_replay_corpora(directory, options.megabytes)
+        if options.corpus is not None:
+            recordings = {options.corpus: recordings[options.corpus]}
+        names = sorted(recordings.keys())
+        print('Replaying %s over %d sessions' % (', '.join(names), options.sessions))
+
+        client = PtyServerClient(framing=options.framing)
+        probe_ids = [client.create(['/bin/cat'])]
+        prober = EchoProber(client, probe_ids)
+        start_cpu = server_cpu_seconds(client)
+        start = time.perf_counter()
+        open_ids = set(client.create(replay_command(recordings[names[i % len(names)]], options))
+                       for i in range(options.sessions))
+        start_bytes = client.bytes_received
+
+        output_bytes = 0
+        output_messages = 0
+        latencies = []
+        next_probe = start
+        while len(open_ids) != 0:
+            now = time.perf_counter()
+            if now >= next_probe:
+                prober.send_probes()
+                next_probe = now + 0.01
+            for msg in client.receive(0.01):
+                latency = prober.handle_message(msg)
+                if latency is not None:
+                    latencies.append(latency)
+                elif msg['type'] == 'output':
+                    output_bytes += len(msg['data'].encode('utf-8'))
+                    output_messages += 1
+                elif msg['type'] == 'closed':
+                    open_ids.discard(msg['id'])
+        elapsed = time.perf_counter() - start
+        server_cpu = server_cpu_seconds(client) - start_cpu
+        wire_bytes = client.bytes_received - start_bytes
+        client.terminate()
+
+    megabytes = output_bytes / 1024 / 1024
+    print('%6.1f MB/s output, %7.0f messages/s, %6.1f MB on the wire' % (
+          megabytes / elapsed, output_messages / elapsed, wire_bytes / 1024 / 1024))
+    print(format_latencies('keystroke', latencies))
+    print('%.3fs server CPU per MB of output' % (server_cpu / max(megabytes, 0.001)))
+
+
+def utf16_length(text):
+    return len(text.encode('utf-16-le')) // 2
+
+
+def server_rss_kb(client):
+    """Resident set size of the server process in KB, or None if it can't be read."""
+    try:
+        with open('/proc/%d/status' % client.process.pid) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def bench_flow_control(options):
+    """Stress test of permit-data-size flow control.
+
+    Sessions flood mixed ASCII, CJK and emoji output while the client only
+    grants a small credit at a time, measured in UTF-16 code units like the
+    Extraterm side does. A new credit is granted when the previous one has
+    been used up, or when output has stopped and nothing can be in flight.
+    The server must never send more than it was granted, and its memory use
+    must stay flat. Credit utilisation shows how much of each grant the
+    server manages to use.
+    """
+    credit = options.credit
+    generator = ('import sys\nline = "ascii \u6f22\u5b57\u304b\u306a \U0001f600\U0001f680 \x1b[31mred\x1b[0m\\n"\n'
+                 'while True: sys.stdout.write(line * 50)\n')
+    client = PtyServerClient(framing=options.framing)
+    pty_ids = [client.create([sys.executable, '-c', generator], permit=credit) for i in range(options.sessions)]
+    idle_time = 0.05
+    received = {pty_id: 0 for pty_id in pty_ids}
+    last_output_time = {pty_id: time.perf_counter() for pty_id in pty_ids}
+    total_units = 0
+    max_overshoot = 0
+    grants = 0
+    rss_samples = []
+
+    def grant(pty_id):
+        nonlocal grants
+        received[pty_id] = 0
+        last_output_time[pty_id] = time.perf_counter()
+        grants += 1
+        client.send({'type': 'permit-data-size', 'id': pty_id, 'size': credit})
+
+    start = time.perf_counter()
+    next_rss_sample = start
+    while time.perf_counter() - start < options.duration:
+        for msg in client.receive(0.01):
+            if msg['type'] != 'output':
+                continue
+            units = utf16_length(msg['data'])
+            total_units += units
+            received[msg['id']] += units
+            last_output_time[msg['id']] = time.perf_counter()
+            max_overshoot = max(max_overshoot, received[msg['id']] - credit)
+            if received[msg['id']] >= credit:
+                grant(msg['id'])
+        now = time.perf_counter()
+        for pty_id in pty_ids:
+            if now - last_output_time[pty_id] > idle_time:
+                grant(pty_id)
+        if now >= next_rss_sample:
+            rss_samples.append(server_rss_kb(client))
+            next_rss_sample += 0.5
+    elapsed = time.perf_counter() - start
+    client.terminate()
+
+    print('Flow control with %d flooding sessions and a credit of %d UTF-16 code units' % (options.sessions, credit))
+    print('%.0f code units/s, %d credits granted, %.1f%% credit utilisation' % (
+          total_units / elapsed, grants, total_units / max(1, grants * credit) * 100))
+    print('Largest overshoot of the permitted data size: %d code units' % max_overshoot)
+    if None not in rss_samples and len(rss_samples) != 0:
+        print('Server RSS: first %dKB, peak %dKB, last %dKB' % (rss_samples[0], max(rss_samples), rss_samples[-1]))
+    if max_overshoot > 0:
+        print('FAIL: The server sent more than it was permitted.')
+        sys.exit(1)
+
+
+def server_cpu_seconds(client):
+    """User plus system CPU time used by the server process, or None if it can't be read."""
+    try:
+        with open('/proc/%d/stat' % client.process.pid) as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def bench_paste(options):
+    """Throughput of a large paste into a session.
+
+    Text is sent as many 1KB write messages while keeping at most 64K chars
+    outstanding, the same window `ProxyPty` uses. The session reads its pty
+    in raw mode and discards everything.
+    """
+    window = 64 * 1024
+    chunk = ('paste \u00e9\u4e2d\U0001f600 ' * 100)[:1024]
+    chunk_units = utf16_length(chunk)
+    chunk_count = options.megabytes * 1024 * 1024 // len(chunk.encode('utf-8'))
+    print('Paste of %dMB as %d write messages into one session' % (options.megabytes, chunk_count))
+
+    client = PtyServerClient()
+    pty_id = client.create(['sh', '-c', 'stty raw -echo; exec cat > /dev/null'])
+    time.sleep(0.2)     # Let stty run before the paste starts.
+
+    start = time.perf_counter()
+    start_cpu = server_cpu_seconds(client)
+    sent = 0
+    outstanding = 0
+    written_messages = 0
+    while sent < chunk_count or outstanding != 0:
+        while sent < chunk_count and outstanding + chunk_units <= window:
+            client.send({'type': 'write', 'id': pty_id, 'data': chunk})
+            sent += 1
+            outstanding += chunk_units
+        for msg in client.receive(1.0):
+            if msg['type'] == 'output-written':
+                outstanding -= msg['chars']
+                written_messages += 1
+    elapsed = time.perf_counter() - start
+    server_cpu = server_cpu_seconds(client) - start_cpu
+    client.terminate()
+
+    print('%5.1f MB/s, %d output-written messages, %4.2fs server CPU' % (
+          options.megabytes / elapsed, written_messages, server_cpu))
+
+
+def bench_spawn(options):
+    """Latency from sending `create` to receiving `created`.
+
+    Sessions started without a cwd can use posix_spawn(). Sessions with a
+    cwd have to change directory in a forked child first.
+    """
+    count = options.sessions * 10
+    print('Creating %d sessions one after another' % count)
+    client = PtyServerClient()
+    client.create(['true'])     # The first one also pays for warming up.
+    for cwd in [None, os.getcwd()]:
+        latencies = []
+        for i in range(count):
+            start = time.perf_counter()
+            client.send({'type': 'create', 'argv': ['true'], 'rows': 24, 'columns': 80, 'cwd': cwd})
+            created = False
+            while not created:
+                for msg in client.receive(5.0):
+                    if msg['type'] == 'created':
+                        latencies.append(time.perf_counter() - start)
+                        created = True
+        print(format_latencies('cwd=%s' % ('none' if cwd is None else 'set'), latencies))
+    client.terminate()
+
+
+def import_server_module():
+    """Import ptyserver2.py in this process for micro-benchmarks of its internals."""
+    sys.path.insert(0, os.path.dirname(SERVER_PATH))
+    return importlib.import_module('ptyserver2')
+
+
+def bench_pool(options):
+    """Time from `create` to the first prompt with and without a warm pool.
+
+    The shell is simulated by a command which takes 200ms to start up and
+    then prints a prompt. Sessions are opened 0.5s apart, like a user
+    opening tabs, which gives the pool time to refill.
+    """
+    argv = ['sh', '-c', 'sleep 0.2; printf "prompt$ "; exec cat']
+    count = options.sessions
+    print('Opening %d sessions with a 200ms shell startup' % count)
+    for pool_size in [0, 2]:
+        client = PtyServerClient()
+        if pool_size != 0:
+            client.send({'type': 'pool', 'size': pool_size, 'argv': argv, 'cwd': None})
+            time.sleep(1.0)
+        latencies = []
+        for i in range(count):
+            start = time.perf_counter()
+            client.send({'type': 'create', 'argv': argv, 'rows': 24, 'columns': 80, 'cwd': None})
+            prompt = False
+            while not prompt:
+                for msg in client.receive(5.0):
+                    if msg['type'] == 'created':
+                        client.send({'type': 'permit-data-size', 'id': msg['id'], 'size': 1024 * 1024})
+                    elif msg['type'] == 'output' and 'prompt$' in msg['data']:
+                        latencies.append(time.perf_counter() - start)
+                        prompt = True
+            time.sleep(0.5)
+        client.terminate()
+        print(format_latencies('pool=%d' % pool_size, latencies))
+
+
+def bench_spool(options):
+    """How long a command producing lots of output takes while its window isn't being read.
+
+    No more output is permitted after the first 4K chars, then after
+    --duration seconds permission is given for everything. Without a spool
+    the command is blocked until then.
+    """
+    generator = make_output_generator(options.megabytes)
+    print('%dMB of output while detached for %.1fs' % (options.megabytes, options.duration))
+    for spool_size in [0, 2 * options.megabytes * 1024 * 1024, options.megabytes * 1024 * 1024 // 2]:
+        client = PtyServerClient(framing=options.framing)
+        start = time.perf_counter()
+        pty_id = client.create([sys.executable, '-c', generator], permit=4096, spool_size=spool_size)
+        output_chars = 0
+        closed_time = None
+        attached = False
+        while closed_time is None:
+            if not attached and time.perf_counter() - start >= options.duration:
+                attached = True
+                client.send({'type': 'permit-data-size', 'id': pty_id, 'size': 1024 * 1024 * 1024})
+            for msg in client.receive(0.05):
+                if msg['type'] == 'output':
+                    output_chars += len(msg['data'])
+                elif msg['type'] == 'closed':
+                    closed_time = time.perf_counter() - start
+        client.terminate()
+        print('spool=%4dMB  command finished after %5.2fs, %6.1fMB of output received' % (
+              spool_size // 1024 // 1024, closed_time, output_chars / 1024 / 1024))
+
+
+def bench_which(options):
+    """Time to resolve a command on a long PATH, like the ones WSL and Cygwin have.
+
+    The filesystem calls per lookup matter most when PATH holds Windows
+    directories where every call is slow. They are counted by wrapping
+    os.stat() and os.access().
+    """
+    import_server_module()
+    from ptyprocess import util
+
+    extra_dirs = ['/mnt/c/Program Files/App%d/bin' % i for i in range(30)] + ['/usr/local/sbin', '/usr/local/bin']
+    path = os.pathsep.join(['/usr/local/bin'] + extra_dirs + ['/usr/bin', '/bin'])
+    print('PATH with %d entries, command in entry %d' % (len(path.split(os.pathsep)), len(extra_dirs) + 2))
+
+    calls = [0]
+    real_stat, real_access = os.stat, os.access
+    def counting_stat(*args, **kwargs):
+        calls[0] += 1
+        return real_stat(*args, **kwargs)
+    def counting_access(*args, **kwargs):
+        calls[0] += 1
+        return real_access(*args, **kwargs)
+
+    def expired_which_cached(cmd, path):
+        # Past WHICH_CACHE_TTL, so only the directory holding the command is checked.
+        util._which_cache[(cmd, path)] = util._which_cache[(cmd, path)][:2] + (0, time.monotonic())
+        return util.which_cached(cmd, path=path)
+
+    def fully_expired_which_cached(cmd, path):
+        # Past WHICH_CACHE_MISS_TTL as well, so every directory searched is checked.
+        util._which_cache[(cmd, path)] = util._which_cache[(cmd, path)][:2] + (0, 0)
+        return util.which_cached(cmd, path=path)
+
+    repeat = 2000
+    lookups = [('which', util.which)]
+    if hasattr(util, 'which_cached'):
+        lookups += [('cached', util.which_cached), ('revalidated', expired_which_cached),
+                    ('all checked', fully_expired_which_cached)]
+    for name, which in lookups:
+        which('ls', path=path)
+        os.stat, os.access = counting_stat, counting_access
+        try:
+            calls[0] = 0
+            which('ls', path=path)
+            call_count = calls[0]
+        finally:
+            os.stat, os.access = real_stat, real_access
+        start = time.perf_counter()
+        for i in range(repeat):
+            which('ls', path=path)
+        elapsed = time.perf_counter() - start
+        print('%-12s %6.1fus per lookup, %3d filesystem calls' % (name, elapsed / repeat * 1000000, call_count))
+
+    # PtyProcess.spawn(resolve_absolute=False) skips this check of an absolute argv[0].
+    os.stat, os.access = counting_stat, counting_access
+    try:
+        calls[0] = 0
+        util.which_cached('/bin/ls', path=path)
+        call_count = calls[0]
+    finally:
+        os.stat, os.access = real_stat, real_access
+    print('absolute     %3d filesystem calls to check /bin/ls, 0 with resolve_absolute=False' % call_count)
+
+
+def bench_dispatch(options):
+    """Cost of dispatching write, resize and permit-data-size commands.
+
+    Runs in process against sessions whose command could not be found. These
+    use the server's `DeadPty` whose writes never block, so this measures the
+    command parsing, lookup and queueing and not the pty itself. Commands are
+    dispatched one at a time, as a batch, and as a batch of writes to one pty
+    the way a paste arrives.
+    """
+    server = import_server_module()
+    server.controller_out = open(os.devnull, 'wb')
+    print('Command dispatch cost per command')
+    for session_count in (10, 100, options.sessions):
+        with contextlib.redirect_stderr(io.StringIO()):
+            while len(server.pty_sessions) < session_count:
+                server.process_command(json.dumps({'type': 'create', 'argv': ['no-such-command-for-bench'],
+                                                   'rows': 24, 'columns': 80, 'cwd': None}))
+        pty_ids = list(server.pty_sessions.keys())
+        commands = []
+        for i in range(3000):
+            pty_id = pty_ids[(i * 7919) % len(pty_ids)]
+            commands.append(json.dumps({'type': 'write', 'id': pty_id, 'data': 'x'}))
+            commands.append(json.dumps({'type': 'resize', 'id': pty_id, 'rows': 24, 'columns': 80}))
+            commands.append(json.dumps({'type': 'permit-data-size', 'id': pty_id, 'size': 0}))
+
+        paste_commands = [json.dumps({'type': 'write', 'id': pty_ids[0], 'data': 'x' * 1024}) for i in range(9000)]
+
+        start = time.perf_counter()
+        for command in commands:
+            server.process_command(command)
+        elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        server.process_commands(commands)
+        batch_elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        server.process_commands(paste_commands)
+        paste_elapsed = time.perf_counter() - start
+
+        for session in server.pty_sessions.values():
+            del session.writer.chars_written_list[:]
+        print('%6d sessions: %6.2fus single, %6.2fus batched, %6.2fus batched paste writes' % (
+              session_count, elapsed / len(commands) * 1000000, batch_elapsed / len(commands) * 1000000,
+              paste_elapsed / len(paste_commands) * 1000000))
+
+
+def bench_environment(options):
+    """Cost of preparing the environment for a new session.
+
+    Runs in process. Cygwin's cygpath isn't available here, so a `printf`
+    process stands in for it to show the cost of converting PATH with an
+    extra process for every session.
+    """
+    server = import_server_module()
+    repeat = 200
+
+    start = time.perf_counter()
+    for i in range(repeat):
+        server.session_spawn_args({'argv': ['sh'], 'cwd': None})
+    print('create without env: %7.1fus' % ((time.perf_counter() - start) / repeat * 1000000))
+
+    def cygpath_stand_in(args):
+        return subprocess.check_output(['printf', '%s\\n', args[-1]])
+
+    real_subprocess = server.subprocess
+    server.subprocess = type('CygpathStandIn', (), {'check_output': staticmethod(cygpath_stand_in)})
+    try:
+        path = os.environ.get('PATH', '')
+        start = time.perf_counter()
+        for i in range(repeat):
+            getattr(server, 'cygwin_path_cache', {}).clear()
+            server.cygwin_convert_path_variable(path)
+        print('PATH conversion, uncached: %7.1fus' % ((time.perf_counter() - start) / repeat * 1000000))
+        start = time.perf_counter()
+        for i in range(repeat):
+            server.cygwin_convert_path_variable(path)
+        print('PATH conversion, repeated: %7.1fus' % ((time.perf_counter() - start) / repeat * 1000000))
+    finally:
+        server.subprocess = real_subprocess
+
+
+BENCHMARKS = {
+    'bulk-output': bench_bulk_output,
+    'close-latency': bench_close_latency,
+    'compression': bench_compression,
+    'dispatch': bench_dispatch,
+    'encoding': bench_encoding,
+    'environment': bench_environment,
+    'flow-control': bench_flow_control,
+    'framing': bench_framing,
+    'interactive': bench_interactive,
+    'lone-surrogate': bench_lone_surrogate,
+    'paste': bench_paste,
+    'pool': bench_pool,
+    'process-tracking': bench_process_tracking,
+    'replay': bench_replay,
+    'resize': bench_resize,
+    'spawn': bench_spawn,
+    'spool': bench_spool,
+    'which': bench_which,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the ptyserver2.py proxy pty server.')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()), help='Benchmark to run.')
+    parser.add_argument('--sessions', type=int, default=None, help='Number of concurrent sessions. (dispatch defaults to 1000)')
+    parser.add_argument('--corpus', default=None, help='Only replay this corpus (cat, compiler, curses, find) or recording.')
+    parser.add_argument('--credit', type=int, default=4096, help='Permitted data size granted at a time.')
+    parser.add_argument('--duration', type=float, default=5.0, help='Seconds to run for.')
+    parser.add_argument('--framing', choices=['json', 'binary'], default='json', help='Framing to use for server output.')
+    parser.add_argument('--megabytes', type=int, default=20, help='Megabytes of output per session.')
+    parser.add_argument('--stubborn', type=int, default=3, help='Number of sessions which resist being closed.')
+    parser.add_argument('--workers', type=int, default=0, help='Run the server sharded over this many worker processes.')
+    parser.add_argument('--warmup', type=float, default=1.0, help='Seconds to measure before the benchmark action.')
+    parser.add_argument('--recording', action='append', default=[],
+                        help='Raw output or pty_spy.py -t capture to replay. May be repeated.')
+    parser.add_argument('--recorded-speed', action='store_true', help='Replay pty_spy.py captures at their recorded speed.')
+    parser.add_argument('--server', default=SERVER_PATH, help='Path of the ptyserver2.py to benchmark.')
+    options = parser.parse_args()
+    PtyServerClient.server_path = options.server
+    if options.workers > 1:
+        PtyServerClient.server_args = ['--workers', str(options.workers)]
+    if options.sessions is None:
+        options.sessions = 1000 if options.benchmark == 'dispatch' else 10
+    BENCHMARKS[options.benchmark](options)
+
+if __name__ == '__main__':
+    main()